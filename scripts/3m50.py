@@ -1,15 +1,39 @@
 #!/usr/bin/env python
 
 from datetime import date, datetime, timedelta
+from email.mime.text import MIMEText
 import argparse
+import cgi
+import BaseHTTPServer
+import collections
+import fcntl
+import httplib
 import json
+import math
+import mmap
+import glob
 import urllib
-import urllib2
+import urlparse
 import os
+import smtplib
+import socket
+import SocketServer
+import sqlite3
+import struct
 import time
 import sys
+import tempfile
+import threading
 import logging
 import logging.handlers
+import multiprocessing
+import zlib
+
+# numpy is only needed by the analyze command
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # This script will poll the specified 3m50 and get usage data. The 3m50 does
 # not store much onboard data, outside of yesterday's total usage, and today's
@@ -34,7 +58,8 @@ import logging.handlers
 # If this script finds data files, it will print a pretty printed report to
 # STDOUT. If am email address is specified (--email) the script will also
 # email the report. If --hour is specified, the email will only be sent at
-# that hour.
+# that hour. The full data tables are only printed when the report is
+# emailed (or with --verbose), otherwise just the day summaries.
 #
 # If --key and --url are specified, the script will poll weather underground
 # to get current outdoor temperature. This makes the data more useful,
@@ -68,7 +93,180 @@ first_commented_line = '{:>12}'.format('#      Date,') + \
 minuteOffset = 5
 
 # Class definitions
+class PhaseTimer(object):
+    # Times a with block as one phase, see Metrics.timer
+    def __init__(self, metrics, device, phase):
+        self.metrics = metrics
+        self.device = device
+        self.phase = phase
+    def __enter__(self):
+        self.startedAt = time.time()
+        return self
+    def __exit__(self, type, value, traceback):
+        self.metrics.observe(self.device, self.phase, time.time() - self.startedAt)
+        return False
+
+class Metrics(object):
+    # Where the time of a run (or of a daemon cycle) goes, by device and
+    # phase, e.g. 'weather', 'GET /tstat' or 'rollover wait', and counters
+    # of requests, retries, failures and the like. A device of None stands
+    # for the run as a whole, e.g. sending the emails. Counters are also
+    # totalled over the life of the process.
+    #
+    # At the end of a run export() appends a JSON line to jsonFile and
+    # rewrites textFile for Prometheus' node exporter textfile collector.
+    def __init__(self, jsonFile=None, textFile=None):
+        self.jsonFile = jsonFile
+        self.textFile = textFile
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.start()
+    def start(self):
+        with self.lock:
+            self.startedAt = time.time()
+            self.timings = {}
+            self.counters = {}
+    def observe(self, device, phase, seconds):
+        with self.lock:
+            timing = self.timings.setdefault((device, phase), [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+    def increment(self, device, name, count=1):
+        with self.lock:
+            self.counters[(device, name)] = self.counters.get((device, name), 0) + count
+            self.totals[(device, name)] = self.totals.get((device, name), 0) + count
+    def timer(self, device, phase):
+        return PhaseTimer(self, device, phase)
+    def getRun(self):
+        # The run so far as a JSON friendly dict
+        with self.lock:
+            devices = {}
+            run = {'time': datetime.fromtimestamp(self.startedAt).strftime('%Y-%m-%dT%H:%M:%S'),
+                   'seconds': round(time.time() - self.startedAt, 6), 'devices': devices}
+            for (device, phase), (count, total, longest) in self.timings.items():
+                entry = run if device is None else devices.setdefault(device, {})
+                entry.setdefault('phases', {})[phase] = {'count': count, 'seconds': round(total, 6), 'max': round(longest, 6)}
+            for (device, name), count in self.counters.items():
+                entry = run if device is None else devices.setdefault(device, {})
+                entry.setdefault('counters', {})[name] = count
+            return run
+    def getTextfile(self):
+        # Prometheus text format. Phase timings are gauges of the last run,
+        # counters are totals since the process started.
+        run = self.getRun()
+        lines = []
+        lines.append("# HELP thermostat_phase_seconds Seconds spent in each phase of the last run")
+        lines.append("# TYPE thermostat_phase_seconds gauge")
+        with self.lock:
+            timings = sorted(self.timings.items())
+            totals = sorted(self.totals.items())
+        for (device, phase), (count, total, longest) in timings:
+            lines.append("thermostat_phase_seconds" + format_labels(device, phase=phase) + " " + repr(total))
+        lines.append("# HELP thermostat_phase_max_seconds Longest single occurrence of each phase in the last run")
+        lines.append("# TYPE thermostat_phase_max_seconds gauge")
+        for (device, phase), (count, total, longest) in timings:
+            lines.append("thermostat_phase_max_seconds" + format_labels(device, phase=phase) + " " + repr(longest))
+        lines.append("# HELP thermostat_phase_count Number of times each phase ran in the last run")
+        lines.append("# TYPE thermostat_phase_count gauge")
+        for (device, phase), (count, total, longest) in timings:
+            lines.append("thermostat_phase_count" + format_labels(device, phase=phase) + " " + str(count))
+        for name in sorted(set(name for (device, name), count in totals)):
+            metric = "thermostat_" + name.replace(' ', '_') + "_total"
+            lines.append("# TYPE " + metric + " counter")
+            for (device, counterName), count in totals:
+                if counterName == name:
+                    lines.append(metric + format_labels(device) + " " + str(count))
+        lines.append("# HELP thermostat_run_seconds Duration of the last run")
+        lines.append("# TYPE thermostat_run_seconds gauge")
+        lines.append("thermostat_run_seconds " + repr(run['seconds']))
+        lines.append("# HELP thermostat_last_run_timestamp_seconds When the last run finished")
+        lines.append("# TYPE thermostat_last_run_timestamp_seconds gauge")
+        lines.append("thermostat_last_run_timestamp_seconds " + repr(time.time()))
+        return "\n".join(lines) + "\n"
+    def export(self):
+        # Writes out the run that just ended and starts a new one
+        if self.jsonFile is not None:
+            try:
+                with open(self.jsonFile, 'a') as f:
+                    f.write(json.dumps(self.getRun(), sort_keys=True) + "\n")
+            except Exception as e:
+                logger.error("Error writing metrics to " + self.jsonFile)
+                logger.exception(e)
+        if self.textFile is not None:
+            try:
+                # The collector may read the file at any time, so it is
+                # replaced in one go
+                tmpname = self.textFile + ".tmp"
+                with open(tmpname, 'w') as f:
+                    f.write(self.getTextfile())
+                os.rename(tmpname, self.textFile)
+            except Exception as e:
+                logger.error("Error writing metrics to " + self.textFile)
+                logger.exception(e)
+        self.start()
+
+def format_labels(device, **labels):
+    # {device="...",phase="..."} in Prometheus' text format
+    if device is not None:
+        labels['device'] = device
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(key + '="' + escape(labels[key]) + '"' for key in sorted(labels)) + "}"
+
+class HttpConnection(object):
+    # A keep-alive HTTP connection to a single host. Requests are serialized
+    # on the one connection. If the peer dropped an idle connection we
+    # reconnect and retry once, but never after a timeout, which would only
+    # double the wait on a device that is not answering.
+    #
+    # Every request is timed as a phase of its own, e.g. 'GET /tstat'.
+    def __init__(self, hostName, timeout=None, metrics=None):
+        self.hostName = hostName
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.connection = None
+        self.requests = 0
+        self.lock = threading.Lock()
+    def request(self, method, path, body=None):
+        with self.lock:
+            with self.metrics.timer(self.hostName, method + " " + path):
+                while True:
+                    reused = self.connection is not None
+                    if not reused:
+                        self.connection = httplib.HTTPConnection(self.hostName, timeout=self.timeout)
+                    self.metrics.increment(self.hostName, 'requests')
+                    self.requests += 1
+                    try:
+                        self.connection.request(method, path, body)
+                        response = self.connection.getresponse()
+                        data = response.read()
+                    except (httplib.HTTPException, socket.error) as e:
+                        self.close()
+                        if reused and not isinstance(e, socket.timeout):
+                            logger.debug("Connection to " + self.hostName + " went stale, reconnecting")
+                            self.metrics.increment(self.hostName, 'retries')
+                            continue
+                        self.metrics.increment(self.hostName, 'timeouts' if isinstance(e, socket.timeout) else 'failures')
+                        raise
+                    if response.will_close:
+                        self.close()
+                    if response.status >= 400:
+                        self.metrics.increment(self.hostName, 'failures')
+                        raise IOError("HTTP " + str(response.status) + " " + response.reason + " from " + self.hostName + path)
+                    return data
+    def getJson(self, path):
+        return json.loads(self.request('GET', path))
+    def post(self, path, body):
+        return self.request('POST', path, body)
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
 class Temperature(object):
+    __slots__ = ('tempImperialUnit', 'tempMetricUnit')
     def __init__(self, tempImperialUnit, tempMetricUnit):
         self.tempImperialUnit = tempImperialUnit
         self.tempMetricUnit = tempMetricUnit
@@ -76,20 +274,232 @@ class Temperature(object):
         return "Imperial: " + str(self.tempImperialUnit) + " F, Metric: " + str(self.tempMetricUnit) + " C" 
 
 class Runtime(object):
+    __slots__ = ('heatRuntime', 'coolRuntime')
     def __init__(self, coolRuntime, heatRuntime):
         self.heatRuntime = int(heatRuntime)
         self.coolRuntime = int(coolRuntime)
     def __str__(self):
         return "Heat Runtime: " + str(self.heatRuntime) + " minutes, Cool Runtime: " + str(self.coolRuntime) + " minutes" 
 
+class Sample(object):
+    # One row of a data file. Values shown as '--' in the data files are
+    # None here. Days and years of them are held in memory at once, so a
+    # sample has slots instead of a dict.
+    __slots__ = ('date', 'time', 'outdoorTemperature', 'setTemperature', 'indoorTemperature', 'tempDiff', 'heatTotal', 'coolTotal', 'heatRun', 'coolRun', 'mode')
+    def __init__(self, date, time, outdoorTemperature=None, setTemperature=None, indoorTemperature=None, tempDiff=None, heatTotal=None, coolTotal=None, heatRun=None, coolRun=None, mode=None):
+        self.date = date
+        self.time = time
+        self.outdoorTemperature = outdoorTemperature
+        self.setTemperature = setTemperature
+        self.indoorTemperature = indoorTemperature
+        self.tempDiff = tempDiff
+        self.heatTotal = heatTotal
+        self.coolTotal = coolTotal
+        self.heatRun = heatRun
+        self.coolRun = coolRun
+        self.mode = mode
+    def getRuntime(self):
+        if self.heatTotal is None or self.coolTotal is None:
+            return None
+        return Runtime(self.coolTotal, self.heatTotal)
+    def __str__(self):
+        return format_csv_line(self)
+
+class DaySummary(object):
+    # What reports need to know about a day without reading all of it: how
+    # many samples there are, the last one, and the range of temperatures.
+    def __init__(self):
+        self.rows = 0
+        self.lastSample = None
+        self.indoorTemperatures = None
+        self.outdoorTemperatures = None
+    def add(self, sample):
+        self.rows += 1
+        self.lastSample = sample
+        self.indoorTemperatures = self.extend(self.indoorTemperatures, sample.indoorTemperature)
+        self.outdoorTemperatures = self.extend(self.outdoorTemperatures, sample.outdoorTemperature)
+    @staticmethod
+    def extend(bounds, value):
+        # (min, max) bounds, None until there is a known value
+        if value is None:
+            return bounds
+        if bounds is None:
+            return (value, value)
+        return (min(bounds[0], value), max(bounds[1], value))
+    def getRuntime(self):
+        if self.lastSample is None:
+            return None
+        return self.lastSample.getRuntime()
+    def __str__(self):
+        summary = str(self.rows) + " samples"
+        if self.indoorTemperatures is not None:
+            summary += ", indoor " + str(self.indoorTemperatures[0]) + " to " + str(self.indoorTemperatures[1])
+        if self.outdoorTemperatures is not None:
+            summary += ", outdoor " + str(self.outdoorTemperatures[0]) + " to " + str(self.outdoorTemperatures[1])
+        return summary
+
+# Responses from the 3m50 are cached as snapshots. A snapshot is considered
+# fresh for snapshotTTL seconds, so every getter called during one run is
+# served from a single GET of /tstat and a single GET of /tstat/datalog.
+# Callers that need the device's live state (e.g. waiting for the midnight
+# rollover) ask for a snapshot with a maxAge of 0 to force a refetch.
+snapshotTTL = 60
+
+# The 3m50's clock only has minute resolution, so all we learn from one
+# /tstat is that the device's clock is somewhere in a 60 second window
+# relative to ours. Windows from successive runs are intersected (see
+# update_clock_offset) after widening the older one by clockDriftPerHour
+# seconds for every hour since it was measured.
+clockDriftPerHour = 2
+secondsPerWeek = 7*24*60*60
+
+# The midnight sample waits for the 3m50 to roll over to the next day. We
+# never wait if the rollover is predicted further out than rolloverMaxWait
+# seconds, we wake up rolloverMargin seconds before the earliest instant it
+# could happen, and we give up rolloverGrace seconds after the latest.
+rolloverMaxWait = 150
+rolloverMargin = 2
+rolloverGrace = 30
+
+# After the clock rolls over the 3m50 still has to move today's usage to
+# yesterday's bucket. We poll for up to transferSettle + transferTimeout
+# seconds until today's bucket has been reset. A day without any runtime
+# looks the same before and after, so then the 3m50 gets transferSettle
+# seconds, as it always did, and yesterday's bucket is taken as it is.
+transferSettle = 5
+transferTimeout = 15
+
+# The longest the midnight sample can take: the wait for the rollover (up to
+# rolloverMaxWait seconds, plus the minute the device's clock is uncertain
+# by, plus rolloverGrace) and for the transfer. Deadlines of the midnight
+# sample are extended by this much.
+rolloverBudget = rolloverMaxWait + 60 + rolloverGrace + transferSettle + transferTimeout
+
+# A thermostat that failed to answer downFailures times in a row is
+# considered down. Polls of a down thermostat return right away, except for
+# a probe every probeBackoff seconds, doubling after every failed probe up
+# to probeMaxBackoff. Backoffs run from when the failed poll started, and a
+# probe is due up to probeSlack seconds early, so that a run that starts a
+# little early is not one period late to probe, as cron runs every hour.
+downFailures = 3
+probeBackoff = 60
+probeMaxBackoff = 60*60
+probeSlack = 30
+
+def get_seconds_of_week(timestamp):
+    # Monday 00:00:00 local time is 0, which is also how the 3m50 counts days
+    t = datetime.fromtimestamp(timestamp)
+    return t.weekday()*24*60*60 + t.hour*60*60 + t.minute*60 + t.second + t.microsecond/1000000.0
+
+def normalize_clock_offset(offset):
+    # Offsets wrap around the week; keep them in [-half a week, half a week)
+    return (offset + secondsPerWeek/2) % secondsPerWeek - secondsPerWeek/2
+
+def normalize_seconds_of_day(seconds):
+    # Times of day in [-12 hours, 12 hours), so that 23:59:30 is -30
+    return (seconds + 12*60*60) % (24*60*60) - 12*60*60
+
+class TstatSnapshot(object):
+    def __init__(self, data, fetchedAt, sentAt=None):
+        self.data = data
+        self.fetchedAt = fetchedAt
+        self.temp = data.get('temp')
+        self.tmode = data.get('tmode')
+        self.tstate = data.get('tstate')
+        self.heatSetTemperature = data.get('t_heat')
+        self.coolSetTemperature = data.get('t_cool')
+        self.day = data['time']['day']
+        self.hour = data['time']['hour']
+        self.minute = data['time']['minute']
+        # Best guess for when the device read its clock: halfway through the
+        # request. It could have been any time within the round trip.
+        if sentAt is None:
+            sentAt = fetchedAt
+        self.roundTrip = fetchedAt - sentAt
+        self.clockReadAt = (sentAt + fetchedAt)/2.0
+    def getClockOffsetWindow(self):
+        # (low, high) bounds in seconds for device clock minus our clock. The
+        # device's clock was somewhere in the minute it reported when it read
+        # it, and it read it somewhere within the round trip.
+        deviceSeconds = self.day*24*60*60 + self.hour*60*60 + self.minute*60
+        low = normalize_clock_offset(deviceSeconds - get_seconds_of_week(self.clockReadAt + self.roundTrip/2.0))
+        return (low, low + 60 + self.roundTrip)
+    def getSetTemperature(self):
+        if self.tmode == 2:
+            return self.coolSetTemperature
+        elif self.tmode == 1:
+            return self.heatSetTemperature
+        return None
+    def getMode(self):
+        if self.tmode == 2:
+            return "COOL"
+        elif self.tmode == 1:
+            return "HEAT"
+        return None
+    def age(self):
+        return time.time() - self.fetchedAt
+    def isFresh(self, ttl):
+        return self.age() <= ttl
+    def __str__(self):
+        return "Temp: " + str(self.temp) + ", Mode: " + str(self.tmode) + ", Time: " + '{:0>2}'.format(str(self.hour)) + ":" + '{:0>2}'.format(str(self.minute))
+
+class DatalogSnapshot(object):
+    def __init__(self, data, fetchedAt):
+        self.data = data
+        self.fetchedAt = fetchedAt
+        self.today = self.getRuntime(data['today'])
+        self.yesterday = self.getRuntime(data['yesterday'])
+    @staticmethod
+    def getRuntime(bucket):
+        coolRuntimeMinutes = bucket['cool_runtime']['hour']*60 + bucket['cool_runtime']['minute']
+        heatRuntimeMinutes = bucket['heat_runtime']['hour']*60 + bucket['heat_runtime']['minute']
+        return Runtime(coolRuntimeMinutes, heatRuntimeMinutes)
+    def age(self):
+        return time.time() - self.fetchedAt
+    def isFresh(self, ttl):
+        return self.age() <= ttl
+    def __str__(self):
+        return "Today: " + str(self.today) + ", Yesterday: " + str(self.yesterday)
+
 class Thermostat(object):
-    def __init__(self, hostName):
+    def __init__(self, hostName, ttl=snapshotTTL, timeout=None, metrics=None):
         self.hostName = hostName
+        self.ttl = ttl
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.connection = HttpConnection(hostName, timeout, self.metrics)
+        # /tstat/datalog has a connection of its own, so that it can be
+        # fetched at the same time as /tstat.
+        self.datalogConnection = HttpConnection(hostName, timeout, self.metrics)
+        self.tstatSnapshot = None
+        self.datalogSnapshot = None
+    def getTstatSnapshot(self, maxAge=None):
+        if maxAge is None:
+            maxAge = self.ttl
+        if self.tstatSnapshot is None or not self.tstatSnapshot.isFresh(maxAge):
+            path = '/tstat'
+            sentAt = time.time()
+            data = self.connection.getJson(path)
+            self.tstatSnapshot = TstatSnapshot(data, time.time(), sentAt)
+            logger.debug("Fetched " + path + " from " + self.hostName + ": " + str(self.tstatSnapshot))
+        return self.tstatSnapshot
+    def getDatalogSnapshot(self, maxAge=None):
+        if maxAge is None:
+            maxAge = self.ttl
+        if self.datalogSnapshot is None or not self.datalogSnapshot.isFresh(maxAge):
+            path = '/tstat/datalog'
+            data = self.datalogConnection.getJson(path)
+            self.datalogSnapshot = DatalogSnapshot(data, time.time())
+            logger.debug("Fetched " + path + " from " + self.hostName + ": " + str(self.datalogSnapshot))
+        return self.datalogSnapshot
+    def invalidate(self):
+        self.tstatSnapshot = None
+        self.datalogSnapshot = None
+    def getRequestCount(self):
+        # Requests sent to the thermostat so far, retries included
+        return self.connection.requests + self.datalogConnection.requests
     def isUp (self):
         try:
-            uri = 'http://' + self.hostName
-            path = '/tstat'
-            urllib2.urlopen(uri + path)
+            self.getTstatSnapshot()
             return True
         except Exception as e:
             logger.error("Error checking if thermostat " + self.hostName + " is up")
@@ -97,50 +507,30 @@ class Thermostat(object):
             return False
     def getCurrentIndoorTemperature(self):
         try:
-            uri = 'http://' + self.hostName
-            path = '/tstat'
-            data = json.load(urllib2.urlopen(uri + path))
-            return data['temp']
+            return self.getTstatSnapshot().temp
         except Exception as e:
             logger.error("Error getting indoor temperature from " + self.hostName)
             logger.exception(e)
             return None
     def getMode(self):
         try:
-            uri = 'http://' + self.hostName
-            path = '/tstat'
-            data = json.load(urllib2.urlopen(uri + path))
-            mode = data['tmode']
-            if mode == 2:
-                return "COOL"
-            elif mode == 1:
-                return "HEAT"
+            return self.getTstatSnapshot().getMode()
         except Exception as e:
             logger.error("Error getting current set temperature from " + self.hostName)
             logger.exception
             return "UNKNOWN"
     def getCurrentSetTemperature(self):
         try:
-            uri = 'http://' + self.hostName
-            path = '/tstat'
-            data = json.load(urllib2.urlopen(uri + path))
-            mode = data['tmode']
-            if mode == 2:
-                return data['t_cool']
-            elif mode == 1:
-                return data['t_heat']
+            return self.getTstatSnapshot().getSetTemperature()
         except Exception as e:
             logger.error("Error getting current set temperature from " + self.hostName)
             logger.exception(e)
             return None
     def hasThermostatTransferredData(self):
         try:
-            uri = 'http://' + self.hostName
-            path = '/tstat'
-            data = json.load(urllib2.urlopen(uri + path))
-
-            hour = data['time']['hour']
-            if hour == 0:
+            # Always ask the device, the whole point is to notice when its
+            # clock rolls over.
+            if self.getTstatSnapshot(maxAge=0).hour == 0:
                 return True
             return False
         except Exception as e:
@@ -148,28 +538,100 @@ class Thermostat(object):
             logger.exception(e)
             return None
     def syncTime (self):
+        # Sets the thermostat's clock to ours. It only takes an hour and a
+        # minute and starts its seconds over from 0, so the POST is sent to
+        # reach it as our clock turns to the next minute, half a round trip
+        # early. Returns the (low, high) window of its clock minus ours
+        # afterwards: it got the POST after we sent it and before it
+        # answered. None if that failed.
         try:
-            uri = 'http://' + self.hostName
             path = '/tstat'
-            data = json.load(urllib2.urlopen(uri + path))
-            logger.info("Current time on thermostat is: " + '{:0>2}'.format(str(data['time']['hour'])) + ":" + '{:0>2}'.format(str(data['time']['minute'])))
-
-            hour = datetime.now().hour
-            minute = datetime.now().minute
-            logger.info("Setting time on thermostat to: " + '{:0>2}'.format(str(hour)) + ":" + '{:0>2}'.format(str(minute).format(":0>2")))
-            data = '{\"time\":{\"hour\":' + str(hour) + ',\"minute\":' + str(minute) + '}}'
-            response = urllib2.urlopen(uri + path, data).read()
-            return True
+            snapshot = self.getTstatSnapshot()
+            lead = snapshot.roundTrip/2.0
+            minute = (math.floor((time.time() + lead + 1)/60) + 1)*60
+            time.sleep(max(0, minute - lead - time.time()))
+            target = datetime.fromtimestamp(minute)
+            logger.info("Setting time on " + self.hostName + " to " + convert_date_to_str_HHMM_with_colon(target) + ", it was at " + '{:0>2}'.format(str(snapshot.hour)) + ":" + '{:0>2}'.format(str(snapshot.minute)))
+            data = json.dumps({'time': {'hour': target.hour, 'minute': target.minute}})
+            sentAt = time.time()
+            self.connection.post(path, data)
+            answeredAt = time.time()
+            # The device's clock just changed under our cached snapshot
+            self.tstatSnapshot = None
+            return (minute - answeredAt, minute - sentAt)
         except Exception as e:
             logger.error("Error Synchronizing time with " + self.hostName)
             logger.exception(e)
+            return None
+
+    def waitForRollover(self, clockOffset=None):
+        # Returns True once the thermostat's clock has passed midnight, False
+        # if it did not get there in time. clockOffset is the (low, high)
+        # window for the device's clock minus ours, in seconds.
+        snapshot = self.getTstatSnapshot()
+        if snapshot.hour == 0:
+            return True
+        if snapshot.hour < 12:
+            # Way past midnight already, nothing to wait for.
+            logger.error(self.hostName + " rolled over hours ago, its clock is at " + '{:0>2}'.format(str(snapshot.hour)) + ":" + '{:0>2}'.format(str(snapshot.minute)))
+            return True
+
+        if clockOffset is None:
+            clockOffset = snapshot.getClockOffsetWindow()
+        low, high = clockOffset
+
+        # Predict, on our clock, when the device's clock reaches 00:00:00.
+        # The further ahead its clock is (high), the sooner that happens.
+        secondsOfDay = get_seconds_of_week(time.time()) % (24*60*60)
+        earliest = max(0, -normalize_seconds_of_day(secondsOfDay + high))
+        latest = max(0, -normalize_seconds_of_day(secondsOfDay + low))
+        if earliest > rolloverMaxWait:
+            # The thermostat's clock is well behind ours. Both should be on
+            # NTP, so rather than block we log it as an error.
+            logger.error(self.hostName + " is predicted to roll over in " + str(int(earliest)) + " seconds, not waiting for it. Its clock is off by " + str(int(low)) + " to " + str(int(high)) + " seconds")
             return False
 
-    def getCurrentRuntime(self, now):
-        try:
-            uri = 'http://' + self.hostName
-            path = '/tstat/datalog'
+        logger.info("Waiting " + '{:.1f}'.format(earliest) + " to " + '{:.1f}'.format(latest) + " seconds for " + self.hostName + " to roll over")
+        deadline = time.time() + max(earliest, latest) + rolloverGrace
+        time.sleep(max(0, earliest - rolloverMargin))
 
+        # Poll with a short backoff around the predicted instant. It only
+        # grows past rolloverMargin once the rollover is overdue.
+        delay = 0.5
+        while True:
+            if self.hasThermostatTransferredData():
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay*2, rolloverMargin if remaining > rolloverGrace else 4)
+    def getTransferredRuntime(self, previousRuntime=None):
+        # Right after the rollover the 3m50 moves today's usage into
+        # yesterday's bucket and starts today's over. Until then yesterday's
+        # bucket still holds the day before, which may be more or less than
+        # today, so the transfer is told from today's bucket instead: it has
+        # been reset once it is less than at our last sample of the day.
+        # Without any runtime to go by, that is once it is 0 and
+        # transferSettle seconds have passed.
+        settled = time.time() + transferSettle
+        deadline = settled + transferTimeout
+        delay = 0.5
+        while True:
+            snapshot = self.getDatalogSnapshot(maxAge=0)
+            today = snapshot.today
+            if previousRuntime is not None and (today.heatRuntime < previousRuntime.heatRuntime or today.coolRuntime < previousRuntime.coolRuntime):
+                return snapshot.yesterday
+            if today.heatRuntime == 0 and today.coolRuntime == 0 and time.time() >= settled:
+                return snapshot.yesterday
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.error(self.hostName + " has not transferred today's usage yet, today is still at " + str(today))
+                return snapshot.yesterday
+            time.sleep(min(delay, remaining))
+            delay = min(delay*2, 4)
+    def getCurrentRuntime(self, now, clockOffset=None, previousRuntime=None):
+        try:
             if now.hour == 0 and now.minute <= minuteOffset: 
                 # We have been asked the current runtime at midnight. What is
                 # actually being requested is the usage between 23:00 to midnight.
@@ -178,43 +640,24 @@ class Thermostat(object):
                 # yesterday's bucket at midnight. So, essentially we need yesterday's usage.
                 #
                 # This part of the code is very sensitive to time
-                # syncronization between the client machine and the 3m50
-                # therefore you see sleeps.
+                # syncronization between the client machine and the 3m50.
+                # Rather than sleeping blindly we use the measured offset
+                # between the two clocks (clockOffset) to predict when the
+                # thermostat rolls over and only poll around then.
                 #
                 # Also, note minuteOffset comes into play here. For any time
                 # between 12:00 and 12:00 + minuteOffset, we consider that
                 # we are going to get yesterdays usage
-                attempt = 0
-                while self.hasThermostatTransferredData() == False:
-                    #Thermostat is still one day behind.
-                    if attempt > 4:
-                        # This means that the client machine is over 1.5 minutes
-                        # off in time than the thermostat.
-                        #
-                        # This should not be the case, since both machines
-                        # should be on NTP.
-                        #
-                        # We log this as an error by returning a negative
-                        # runtime.
-                        return Runtime(-1, -1)
-                        break
-                    logger.info("Sleeping 30")
-                    time.sleep(30) #Give the thermostat 30 seconds to move todays usage to yestedays usage
-                    attempt += 1
-
-                time.sleep(5) # We know that the thermostat thinks it is tomorrow. 
-                              # But we do not know the today's data has been
-                              # successfully transferred to yesterdays. So we
-                              # sleep for 5 seconds to give the thermostat time
-                              # to transfer the data
-                data = json.load(urllib2.urlopen(uri + path))
-                coolRuntimeMinutes = data['yesterday']['cool_runtime']['hour']*60 + data['yesterday']['cool_runtime']['minute']
-                heatRuntimeMinutes = data['yesterday']['heat_runtime']['hour']*60 + data['yesterday']['heat_runtime']['minute']
+                with self.metrics.timer(self.hostName, 'rollover wait'):
+                    rolledOver = self.waitForRollover(clockOffset)
+                if not rolledOver:
+                    # We log this as an error by returning a negative
+                    # runtime.
+                    return Runtime(-1, -1)
+                with self.metrics.timer(self.hostName, 'transfer wait'):
+                    return self.getTransferredRuntime(previousRuntime)
             else:
-                data = json.load(urllib2.urlopen(uri + path))
-                coolRuntimeMinutes = data['today']['cool_runtime']['hour']*60 + data['today']['cool_runtime']['minute']
-                heatRuntimeMinutes = data['today']['heat_runtime']['hour']*60 + data['today']['heat_runtime']['minute']
-            return Runtime(coolRuntimeMinutes, heatRuntimeMinutes)
+                return self.getDatalogSnapshot().today
         except Exception as e:
             logger.error("Error getting current runtime from " + self.hostName)
             logger.exception(e)
@@ -241,154 +684,1324 @@ def convert_date_to_str_HHMM_with_colon(date):
     dateString = date.strftime('%H:%M')
     return dateString
 
-def get_outdoor_temperature_right_now(wundergroundApiKey, url):
-    try:
-        uri = 'http://api.wunderground.com'
-        path = '/api/' + wundergroundApiKey + '/conditions/' + url
-        data = json.load(urllib2.urlopen(uri + path))
-        tempImperialUnit = data['current_observation']['temp_f']
-        tempMetricUnit = data['current_observation']['temp_c']
-        return Temperature(tempImperialUnit, tempMetricUnit)
-    except Exception as e:
-        logger.error("Error getting current outdoor temperature using key " + wundergroundApiKey + " and url " + url)
-        logger.exception(e)
-        return None
+# Outdoor temperature providers. A provider's getTemperature(location)
+# returns a Temperature, or None if it could not get one. A location is
+# whatever the backend understands; for weather underground it is the url
+# suffix of the city, e.g. '/q/NC/Cary.json'.
+class WundergroundProvider(object):
+    def __init__(self, wundergroundApiKey, timeout=None):
+        self.wundergroundApiKey = wundergroundApiKey
+        self.connection = HttpConnection('api.wunderground.com', timeout)
+    def getTemperature(self, location):
+        try:
+            path = '/api/' + self.wundergroundApiKey + '/conditions/' + location
+            data = self.connection.getJson(path)
+            tempImperialUnit = data['current_observation']['temp_f']
+            tempMetricUnit = data['current_observation']['temp_c']
+            return Temperature(tempImperialUnit, tempMetricUnit)
+        except Exception as e:
+            logger.error("Error getting current outdoor temperature using key " + self.wundergroundApiKey + " and url " + location)
+            logger.exception(e)
+            return None
+    def __str__(self):
+        return "wunderground"
 
-def create_datafile_if_needed(fpath):
-    try:
-        with open(fpath) as f: pass
-    except IOError as e:
-        with open(fpath, 'a') as f:
-            f.write(first_commented_line + "\n")
-            f.close()
+class StubProvider(object):
+    # Reports the same temperature (in F) for every location, so we can run
+    # without the network.
+    def __init__(self, tempImperialUnit):
+        self.tempImperialUnit = tempImperialUnit
+    def getTemperature(self, location):
+        return Temperature(self.tempImperialUnit, round((self.tempImperialUnit - 32)*5/9.0, 1))
+    def __str__(self):
+        return "stub:" + str(self.tempImperialUnit)
+
+class CachedTemperatureProvider(object):
+    # Wraps another provider. Temperatures are cached per location for ttl
+    # seconds, in memory and, if cacheFile is set, on disk so that every run
+    # and process on this machine shares them. Concurrent lookups of the
+    # same location collapse into one request: the first caller fetches
+    # while holding the location's lock (and a lock on the cache file), the
+    # others wait and then find the cached value. A failed lookup is
+    # remembered for failureTTL seconds, so it is not retried by everybody
+    # who was waiting on it.
+    failureTTL = 60
+    def __init__(self, backend, ttl, cacheFile=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.cacheFile = cacheFile
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.locationLocks = {}
+    def getCacheKey(self, location):
+        return str(self.backend) + ":" + location
+    def isFresh(self, entry):
+        if entry is None:
+            return False
+        ttl = self.ttl if entry['temp_f'] is not None else CachedTemperatureProvider.failureTTL
+        return time.time() - entry['fetchedAt'] <= ttl
+    def getCached(self, key):
+        # Returns (hit, Temperature or None). The cache file is read whenever
+        # the entry in memory is missing or has expired, as another process
+        # may have fetched the location since.
+        entry = self.cache.get(key)
+        if not self.isFresh(entry) and self.cacheFile is not None:
+            entry = self.readCacheFile().get(key)
+        if not self.isFresh(entry):
+            return (False, None)
+        self.cache[key] = entry
+        if entry['temp_f'] is None:
+            return (True, None)
+        return (True, Temperature(entry['temp_f'], entry['temp_c']))
+    def readCacheFile(self):
+        try:
+            with open(self.cacheFile) as f:
+                return json.load(f)
+        except Exception as e:
+            return {}
+    def writeCacheFile(self, key, entry):
+        try:
+            entries = self.readCacheFile()
+            entries[key] = entry
+            tmpname = self.cacheFile + "." + str(os.getpid()) + ".tmp"
+            with open(tmpname, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmpname, self.cacheFile)
+        except Exception as e:
+            logger.error("Error saving outdoor temperature cache " + self.cacheFile)
+            logger.exception(e)
+    def getTemperature(self, location):
+        key = self.getCacheKey(location)
+        with self.lock:
+            locationLock = self.locationLocks.setdefault(key, threading.Lock())
+        with locationLock:
+            hit, temperature = self.getCached(key)
+            if hit:
+                return temperature
+            lockFile = None
+            if self.cacheFile is not None:
+                # Another process may be fetching the same location
+                lockFile = open(self.cacheFile + ".lock", 'a')
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                if lockFile is not None:
+                    hit, temperature = self.getCached(key)
+                    if hit:
+                        return temperature
+                temperature = self.backend.getTemperature(location)
+                entry = {
+                    'fetchedAt': time.time(),
+                    'temp_f': temperature.tempImperialUnit if temperature is not None else None,
+                    'temp_c': temperature.tempMetricUnit if temperature is not None else None,
+                }
+                self.cache[key] = entry
+                if self.cacheFile is not None:
+                    self.writeCacheFile(key, entry)
+                return temperature
+            finally:
+                if lockFile is not None:
+                    lockFile.close()
+    def __str__(self):
+        return str(self.backend)
 
-def get_last_runtime(filename):
-    try:
-        with open(filename, 'rb') as csvfile:
-            lines = tail(csvfile)
-            return Runtime(lines[0].strip().split(',')[7].strip(), lines[0].strip().split(',')[6].strip())
-    except Exception as e:
+weatherBackends = ['wunderground', 'stub:TEMPERATURE']
+
+def parse_weather(value):
+    # Argparse type for --weather
+    if value == 'wunderground':
+        return value
+    if value.startswith('stub:'):
+        try:
+            float(value[len('stub:'):])
+            return value
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid weather backend '" + value + "', choose from " + ", ".join(weatherBackends))
+
+def create_weather_provider(backend, wundergroundApiKey, timeout, ttl, cacheFile):
+    # Returns None if there is no way to get the outdoor temperature
+    if backend.startswith('stub:'):
+        provider = StubProvider(float(backend[len('stub:'):]))
+    elif wundergroundApiKey is not None:
+        provider = WundergroundProvider(wundergroundApiKey, timeout)
+    else:
+        return None
+    return CachedTemperatureProvider(provider, ttl, cacheFile)
+
+# A data row is 11 columns, each right aligned in 11 characters and followed
+# by a comma. A value that needs more than 11 characters pushes the rest of
+# its row along.
+csvColumns = 11
+csvRowFormat = '%11s,'*csvColumns
+
+def format_csv_line(sample):
+    # The whole row in one format operation
+    return csvRowFormat % (sample.date, sample.time,
+                           '--' if sample.outdoorTemperature is None else sample.outdoorTemperature,
+                           '--' if sample.setTemperature is None else sample.setTemperature,
+                           '--' if sample.indoorTemperature is None else sample.indoorTemperature,
+                           '--' if sample.tempDiff is None else '{:+}'.format(sample.tempDiff),
+                           '--' if sample.heatTotal is None else sample.heatTotal,
+                           '--' if sample.coolTotal is None else sample.coolTotal,
+                           '--' if sample.heatRun is None else sample.heatRun,
+                           '--' if sample.coolRun is None else sample.coolRun,
+                           '--' if sample.mode is None else sample.mode)
+
+def decode_csv_columns(c):
+    # A Sample from the columns of a row, padded or not. Raises a ValueError
+    # for anything that does not parse. Spelled out column by column, as
+    # this is where reading years of data spends its time. Temperatures
+    # without a fraction, as the thermostat sometimes sends them, stay ints
+    # so that the row is written back as it was.
+    return Sample(c[0].strip(), c[1].strip(),
+                  None if '--' in c[2] else float(c[2]) if '.' in c[2] else int(c[2]),
+                  None if '--' in c[3] else float(c[3]) if '.' in c[3] else int(c[3]),
+                  None if '--' in c[4] else float(c[4]) if '.' in c[4] else int(c[4]),
+                  None if '--' in c[5] else float(c[5]) if '.' in c[5] else int(c[5]),
+                  None if '--' in c[6] else int(c[6]),
+                  None if '--' in c[7] else int(c[7]),
+                  None if '--' in c[8] else int(c[8]),
+                  None if '--' in c[9] else int(c[9]),
+                  None if '--' in c[10] else c[10].strip())
+
+def parse_csv_line(line):
+    # Returns None for the commented header line. Anything else that is not
+    # a data row raises a ValueError.
+    if line.lstrip().startswith('#'):
         return None
+    columns = line.split(',')
+    if len(columns) < csvColumns:
+        raise ValueError("Not a data row: " + line.strip())
+    return decode_csv_columns(columns)
+
+def parse_csv_rows(data, source=None):
+    # The Samples of every data row in data, the text of a data file or of
+    # part of it, in one pass. Header lines are skipped, unreadable rows are
+    # logged and skipped.
+    samples = []
+    for line in data.splitlines(True):
+        columns = line.split(',')
+        if len(columns) >= csvColumns and '#' not in columns[0]:
+            try:
+                samples.append(decode_csv_columns(columns))
+            except ValueError as e:
+                logger.error("Skipping unreadable row" + (" in " + source if source is not None else "") + ": " + line.strip())
+        elif line.strip() and not line.lstrip().startswith('#'):
+            logger.error("Skipping unreadable row" + (" in " + source if source is not None else "") + ": " + line.strip())
+    return samples
+
+# The binary record format. Every file starts with a small header, followed
+# by fixed size little endian records, so record n is at
+# recordHeaderSize + n*recordSize. Temperatures are doubles (NaN for '--').
+# Bit n of the last byte is set when temperature n was an int, so that
+# converting a text file to binary and back reproduces it, 66 as well as
+# 66.0. Runtimes are 32 bit ints with recordMissingInt for '--'; -1 is a
+# legitimate value since that is how we record a missed midnight rollover.
+recordMagic = '3m50rec\0'
+recordVersion = 1
+recordHeaderFormat = struct.Struct('<8sII')
+recordFormat = struct.Struct('<HBBBBddddiiiiBB')
+recordHeaderSize = recordHeaderFormat.size
+recordSize = recordFormat.size
+recordMissingInt = -2**31
+recordModes = [None, 'HEAT', 'COOL', 'UNKNOWN']
+
+def encode_record(sample):
+    year, month, day = [int(x) for x in sample.date.split('/')]
+    hour, minute = [int(x) for x in sample.time.split(':')]
+    def f(value):
+        return float('nan') if value is None else value
+    def i(value):
+        return recordMissingInt if value is None else value
+    mode = recordModes.index(sample.mode) if sample.mode in recordModes else recordModes.index('UNKNOWN')
+    temperatures = (sample.outdoorTemperature, sample.setTemperature, sample.indoorTemperature, sample.tempDiff)
+    ints = 0
+    for n, value in enumerate(temperatures):
+        if value is not None and not isinstance(value, float):
+            ints |= 1 << n
+    return recordFormat.pack(year, month, day, hour, minute,
+                             f(temperatures[0]), f(temperatures[1]), f(temperatures[2]), f(temperatures[3]),
+                             i(sample.heatTotal), i(sample.coolTotal), i(sample.heatRun), i(sample.coolRun),
+                             mode, ints)
+
+def decode_record(buf, offset=0):
+    values = recordFormat.unpack_from(buf, offset)
+    ints = values[14]
+    def f(value, n):
+        if value != value: # NaN is the only value not equal to itself
+            return None
+        return int(value) if ints & (1 << n) else value
+    def i(value):
+        return None if value == recordMissingInt else value
+    return Sample('{:04}/{:02}/{:02}'.format(values[0], values[1], values[2]),
+                  '{:02}:{:02}'.format(values[3], values[4]),
+                  f(values[5], 0), f(values[6], 1), f(values[7], 2), f(values[8], 3),
+                  i(values[9]), i(values[10]), i(values[11]), i(values[12]),
+                  recordModes[values[13]])
+
+class RecordFile(object):
+    # A file of fixed size binary records. Reads map the file into memory
+    # and index straight into it, so the last record costs the same no
+    # matter how long the file is.
+    def __init__(self, filename):
+        self.filename = filename
+    def exists(self):
+        return os.path.isfile(self.filename)
+    def count(self):
+        if not self.exists():
+            return 0
+        return max(0, (os.path.getsize(self.filename) - recordHeaderSize)/recordSize)
+    def append(self, sample):
+        self.appendMany([sample])
+    def appendMany(self, samples, hourly=False, syncer=None):
+        # Appends under an exclusive flock, in a single write, and skips
+        # samples the file already has (see is_duplicate_sample).
+        while True:
+            f = open(self.filename, 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_nlink > 0:
+                break
+            # replace() wrote the file over while we waited for the lock
+            f.close()
+        with f:
+            records = []
+            if os.fstat(f.fileno()).st_size == 0:
+                records.append(recordHeaderFormat.pack(recordMagic, recordVersion, recordSize))
+                lastSample = None
+            else:
+                lastSample = self.last()
+            for sample in samples:
+                if is_duplicate_sample(lastSample, sample, hourly):
+                    logger.error("Not appending " + sample.date + " " + sample.time + " to " + self.filename + ", it already has a sample from " + lastSample.date + " " + lastSample.time)
+                    continue
+                records.append(encode_record(sample))
+                lastSample = sample
+            if not records:
+                return
+            os.write(f.fileno(), "".join(records))
+            if syncer is not None:
+                syncer.written(f)
+    def replace(self, samples):
+        # Writes the file over with samples, see TextStore.replaceDay
+        with open(self.filename, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            records = [recordHeaderFormat.pack(recordMagic, recordVersion, recordSize)]
+            records.extend(encode_record(sample) for sample in samples)
+            write_file_over(self.filename, "".join(records))
+    def range(self, start=0, stop=None):
+        # Records start through stop - 1. Negative indexes count from the
+        # end, like a python slice.
+        count = self.count()
+        start, stop, step = slice(start, stop).indices(count)
+        if start >= stop:
+            return []
+        with open(self.filename, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version, size = recordHeaderFormat.unpack_from(buf, 0)
+                if magic != recordMagic or size != recordSize:
+                    raise ValueError(self.filename + " is not a version " + str(recordVersion) + " record file")
+                return [decode_record(buf, recordHeaderSize + n*recordSize) for n in xrange(start, stop)]
+            finally:
+                buf.close()
+    def nth(self, n):
+        records = self.range(n, n + 1 if n != -1 else None)
+        if not records:
+            return None
+        return records[0]
+    def last(self):
+        return self.nth(-1)
+
+# Stores hide how a device's samples are kept. Samples are grouped by day,
+# where a day is a datetime.date; see get_current_day for which day a
+# sample belongs to.
+def get_datafile(filePrefix, day, extension=".txt"):
+    return filePrefix + convert_date_to_str_YYYYMMDD_with_underscore(day) + extension
+
+def get_sidecar(summary, size):
+    # What TextStore keeps about a day file, see TextStore
+    return {
+        'size': size,
+        'rows': summary.rows,
+        'last': format_csv_line(summary.lastSample) if summary.lastSample is not None else None,
+        'indoor': summary.indoorTemperatures,
+        'outdoor': summary.outdoorTemperatures,
+    }
+
+def get_summary_from_sidecar(sidecar):
+    summary = DaySummary()
+    summary.rows = sidecar['rows']
+    summary.lastSample = parse_csv_line(sidecar['last']) if sidecar['last'] is not None else None
+    summary.indoorTemperatures = tuple(sidecar['indoor']) if sidecar['indoor'] is not None else None
+    summary.outdoorTemperatures = tuple(sidecar['outdoor']) if sidecar['outdoor'] is not None else None
+    return summary
+
+archiveExtension = ".txt.gz"
+def get_archive_file(filePrefix, day, extension=archiveExtension):
+    return filePrefix + day.strftime('_%Y_%m') + extension
+
+class DayArchive(object):
+    # A month of text day files, <fileprefix>_YYYY_MM.txt.gz, packed by
+    # '3m50.py compact'. Every day is a gzip member of its own, so the
+    # archive as a whole still zcats to the month's rows, while a single
+    # day is read by seeking to its member and decompressing just that.
+    # A day that is archived again gets a new member; the old one stays
+    # behind unused (and in the output of zcat).
+    #
+    # <archive>.index has, for every day, the offset and length of its
+    # member and the day's summary (see get_sidecar), plus how much of the
+    # archive it covers. Anything past that is left over from an
+    # interrupted compaction and is cut off by the next one.
+    def __init__(self, filename):
+        self.filename = filename
+        self.indexFilename = filename + ".index"
+        self.index = None
+        self.indexStat = None
+    def getIndex(self):
+        # The index is read again only when it changes
+        try:
+            stat = os.stat(self.indexFilename)
+        except OSError:
+            return {'size': 0, 'days': {}}
+        stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if stat != self.indexStat:
+            with open(self.indexFilename) as f:
+                self.index = json.load(f)
+            self.indexStat = stat
+        return self.index
+    def getEntry(self, day):
+        return self.getIndex()['days'].get(convert_date_to_str_YYYYMMDD_with_underscore(day))
+    def getDays(self):
+        return [datetime.strptime(key, '_%Y_%m_%d').date() for key in self.getIndex()['days']]
+    def read(self, entry):
+        # The text of the day of entry, decompressed a chunk at a time
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        with open(self.filename, 'rb') as f:
+            f.seek(entry['offset'])
+            remaining = entry['length']
+            while remaining > 0:
+                chunk = f.read(min(remaining, 65536))
+                if not chunk:
+                    raise IOError(self.filename + " is shorter than its index")
+                remaining -= len(chunk)
+                chunks.append(decompressor.decompress(chunk))
+        chunks.append(decompressor.flush())
+        return "".join(chunks)
+    def add(self, days):
+        # Appends days, a list of (day, text, sidecar). A day that is in the
+        # archive already is replaced.
+        with open(self.filename, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            index = self.getIndex()
+            f.truncate(index['size'])
+            offset = index['size']
+            members = []
+            for day, text, sidecar in days:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                member = compressor.compress(text) + compressor.flush()
+                entry = dict(sidecar)
+                entry['offset'] = offset
+                entry['length'] = len(member)
+                index['days'][convert_date_to_str_YYYYMMDD_with_underscore(day)] = entry
+                offset += len(member)
+                members.append(member)
+            os.write(f.fileno(), "".join(members))
+            os.fsync(f.fileno())
+            index['size'] = offset
+
+            # The index goes last, once everything it points to is on disk
+            tmpname = self.indexFilename + ".tmp"
+            with open(tmpname, 'w') as indexFile:
+                json.dump(index, indexFile)
+                indexFile.flush()
+                os.fsync(indexFile.fileno())
+            os.rename(tmpname, self.indexFilename)
+
+class TextStore(object):
+    # The original format: one padded CSV text file per day,
+    # <fileprefix>_YYYY_MM_DD.txt
+    #
+    # Next to each day file we keep a summary sidecar, <day file>.summary,
+    # that is updated on every append. It holds the DaySummary of the day
+    # and the size of the day file it describes, and nothing that grows with
+    # the rows, so that updating it costs the same for a day of minutely
+    # detail samples as for an hourly one. If that size does not match the
+    # day file, because it was edited or written by an older version, the
+    # sidecar is rebuilt.
+    #
+    # Appends hold an exclusive flock on the day file, which also guards the
+    # sidecar, so that overlapping runs or a fleet polled by several
+    # processes never interleave rows, write the header twice or leave the
+    # sidecar behind. Samples already in the file are skipped, see
+    # is_duplicate_sample.
+    #
+    # Closed days can be packed into monthly archives, see DayArchive and
+    # compact(). A day file, if there is one, takes precedence over the
+    # archived copy of the day. Appending to an archived day starts its day
+    # file from the archived copy.
+    def __init__(self, filePrefix, hourly=False, syncer=None):
+        self.filePrefix = filePrefix
+        self.hourly = hourly
+        self.syncer = syncer if syncer is not None else FileSyncer()
+        self.archives = {}
+    def getDayFile(self, day):
+        return get_datafile(self.filePrefix, day)
+    def getSummaryFile(self, day):
+        return self.getDayFile(day) + ".summary"
+    def getArchive(self, day):
+        filename = get_archive_file(self.filePrefix, day)
+        if filename not in self.archives:
+            self.archives[filename] = DayArchive(filename)
+        return self.archives[filename]
+    def hasDay(self, day):
+        return os.path.isfile(self.getDayFile(day)) or self.getArchive(day).getEntry(day) is not None
+    def getDays(self):
+        days = set(get_days_in_files(self.filePrefix, ".txt"))
+        for filename in glob.glob(self.filePrefix + "_[0-9][0-9][0-9][0-9]_[0-9][0-9]" + archiveExtension):
+            archive = DayArchive(filename)
+            self.archives.setdefault(filename, archive)
+            days.update(self.archives[filename].getDays())
+        return sorted(days)
+    def append(self, day, sample):
+        self.appendMany(day, [sample])
+    def appendMany(self, day, samples):
+        filename = self.getDayFile(day)
+        while True:
+            f = open(filename, 'a+b')
+            # Released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_nlink > 0:
+                break
+            # compact() archived the day while we waited for the lock
+            f.close()
+        with f:
+            summary, size = self.readSummary(day, f)
+            lines = []
+            if size == 0:
+                entry = self.getArchive(day).getEntry(day)
+                if entry is not None:
+                    # Carry on from the archived copy of the day
+                    lines.append(self.getArchive(day).read(entry))
+                    summary = get_summary_from_sidecar(entry)
+                else:
+                    lines.append(first_commented_line + "\n")
+                size = len(lines[0])
+            for sample in samples:
+                if is_duplicate_sample(summary.lastSample, sample, self.hourly):
+                    logger.error("Not appending " + sample.date + " " + sample.time + " to " + filename + ", it already has a sample from " + summary.lastSample.date + " " + summary.lastSample.time)
+                    continue
+                line = format_csv_line(sample) + "\n"
+                summary.add(sample)
+                size += len(line)
+                lines.append(line)
+            if not lines:
+                return
+            # One write, so a reader never sees half a row
+            os.write(f.fileno(), "".join(lines))
+            self.syncer.written(f)
+            self.saveSummary(day, summary, size)
+    def replaceDay(self, day, samples):
+        # Writes the day over with samples, into a new day file that is
+        # renamed into place under the old one's lock. Appends waiting for
+        # the lock move on to the new file, like they do after compact().
+        # An archived day gets a day file again, which takes precedence.
+        filename = self.getDayFile(day)
+        with open(filename, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            summary = DaySummary()
+            lines = [first_commented_line + "\n"]
+            size = len(lines[0])
+            for sample in samples:
+                line = format_csv_line(sample) + "\n"
+                summary.add(sample)
+                size += len(line)
+                lines.append(line)
+            write_file_over(filename, "".join(lines))
+            self.saveSummary(day, summary, size)
+    def saveSummary(self, day, summary, size):
+        sidecar = get_sidecar(summary, size)
+        filename = self.getSummaryFile(day)
+        try:
+            with open(filename + ".tmp", 'w') as f:
+                json.dump(sidecar, f)
+            os.rename(filename + ".tmp", filename)
+        except Exception as e:
+            logger.error("Error saving summary " + filename)
+            logger.exception(e)
+    def getSummaryAndSize(self, day):
+        # Returns (DaySummary, day file size), from the sidecar if it is up
+        # to date or else by reading the day file. Archived days have theirs
+        # in the archive's index.
+        filename = self.getDayFile(day)
+        if not os.path.isfile(filename):
+            entry = self.getArchive(day).getEntry(day)
+            if entry is not None:
+                return get_summary_from_sidecar(entry), entry['size']
+            return DaySummary(), 0
+        with open(filename, 'rb') as f:
+            # Waits for an append in progress to finish with the sidecar
+            fcntl.flock(f, fcntl.LOCK_EX)
+            return self.readSummary(day, f)
+    def readSummary(self, day, f):
+        # getSummaryAndSize of the open and locked day file f
+        filename = self.getDayFile(day)
+        size = os.fstat(f.fileno()).st_size
+        try:
+            with open(self.getSummaryFile(day)) as sidecarFile:
+                sidecar = json.load(sidecarFile)
+            if sidecar['size'] == size:
+                return get_summary_from_sidecar(sidecar), size
+        except Exception as e:
+            pass
 
-def get_previous_runtime(filename, now):
-    if os.path.isfile(filename):
-        return get_last_runtime(filename)
+        summary = DaySummary()
+        offset = 0
+        if size > 0:
+            logger.debug("Rebuilding summary of " + filename)
+            f.seek(0)
+            data = f.read()
+            for sample in parse_csv_rows(data, filename):
+                summary.add(sample)
+            offset = len(data)
+            self.saveSummary(day, summary, offset)
+        return summary, offset
+    def getDaySummary(self, day):
+        if not self.hasDay(day):
+            return None
+        return self.getSummaryAndSize(day)[0]
+    def getDaySummaries(self, days):
+        return dict((day, self.getDaySummary(day)) for day in days)
+    def getLastSample(self, day):
+        summary = self.getDaySummary(day)
+        if summary is None:
+            return None
+        return summary.lastSample
+    def getSamples(self, day):
+        if not self.hasDay(day):
+            return []
+        return parse_csv_rows(self.getDayAsString(day), self.getDayFile(day))
+    def getDayAsString(self, day):
+        if not os.path.isfile(self.getDayFile(day)):
+            archive = self.getArchive(day)
+            entry = archive.getEntry(day)
+            if entry is not None:
+                return archive.read(entry)
+        return get_file_as_string(self.getDayFile(day))
+    def compact(self, before):
+        # Moves the day files of every day before the day before into their
+        # month's archive. Returns the number of days archived.
+        byMonth = {}
+        for day in get_days_in_files(self.filePrefix, ".txt"):
+            if day < before:
+                byMonth.setdefault(get_archive_file(self.filePrefix, day), []).append(day)
+        compacted = 0
+        for filename in sorted(byMonth):
+            files = []
+            try:
+                days = []
+                for day in byMonth[filename]:
+                    # Keep the day files locked until they are gone, so that
+                    # nobody appends to them in the meantime
+                    f = open(self.getDayFile(day), 'rb')
+                    files.append(f)
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    summary, size = self.readSummary(day, f)
+                    f.seek(0)
+                    days.append((day, f.read(), get_sidecar(summary, size)))
+                self.getArchive(byMonth[filename][0]).add(days)
+                for day in byMonth[filename]:
+                    os.remove(self.getDayFile(day))
+                    if os.path.isfile(self.getSummaryFile(day)):
+                        os.remove(self.getSummaryFile(day))
+                compacted += len(days)
+                logger.debug("Archived " + str(len(days)) + " day(s) in " + filename)
+            finally:
+                for f in files:
+                    f.close()
+        return compacted
+    def __str__(self):
+        return "text:" + self.filePrefix
+
+class BinaryStore(object):
+    # One file of fixed size records per day, <fileprefix>_YYYY_MM_DD.bin
+    # Appends are locked and skip duplicates like TextStore's.
+    def __init__(self, filePrefix, hourly=False, syncer=None):
+        self.filePrefix = filePrefix
+        self.hourly = hourly
+        self.syncer = syncer if syncer is not None else FileSyncer()
+    def getDayFile(self, day):
+        return get_datafile(self.filePrefix, day, ".bin")
+    def hasDay(self, day):
+        return os.path.isfile(self.getDayFile(day))
+    def getDays(self):
+        return get_days_in_files(self.filePrefix, ".bin")
+    def append(self, day, sample):
+        self.appendMany(day, [sample])
+    def appendMany(self, day, samples):
+        RecordFile(self.getDayFile(day)).appendMany(samples, self.hourly, self.syncer)
+    def replaceDay(self, day, samples):
+        RecordFile(self.getDayFile(day)).replace(samples)
+    def getLastSample(self, day):
+        try:
+            return RecordFile(self.getDayFile(day)).last()
+        except Exception as e:
+            logger.exception(e)
+            return None
+    def getSamples(self, day):
+        return RecordFile(self.getDayFile(day)).range()
+    def getDayAsString(self, day):
+        # Rendered in the text format, so reports look the same whatever the
+        # store.
+        if not self.hasDay(day):
+            return ""
+        return first_commented_line + "\n" + "".join(format_csv_line(sample) + "\n" for sample in self.getSamples(day))
+    def getDaySummary(self, day):
+        if not self.hasDay(day):
+            return None
+        summary = DaySummary()
+        for sample in self.getSamples(day):
+            summary.add(sample)
+        return summary
+    def getDaySummaries(self, days):
+        return dict((day, self.getDaySummary(day)) for day in days)
+    def __str__(self):
+        return "binary:" + self.filePrefix
+
+class SqliteStore(object):
+    # All devices' samples in one SQLite database, keyed by device and
+    # timestamp. The database runs in WAL mode so that several processes
+    # polling a fleet can write to it without blocking each other or
+    # readers. Each thread gets its own connection.
+    connections = threading.local()
+    columns = ['outdoorTemperature', 'setTemperature', 'indoorTemperature', 'tempDiff', 'heatTotal', 'coolTotal', 'heatRun', 'coolRun', 'mode']
+    def __init__(self, filename, device, hourly=False):
+        self.filename = filename
+        self.device = device
+        self.hourly = hourly
+    def getConnection(self):
+        cache = SqliteStore.connections.__dict__
+        if self.filename not in cache:
+            connection = sqlite3.connect(self.filename, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                # day is the data file the row would be in, which for the
+                # midnight row is the day before its date.
+                connection.execute("""CREATE TABLE IF NOT EXISTS samples (
+                                          device TEXT NOT NULL,
+                                          day TEXT NOT NULL,
+                                          timestamp TEXT NOT NULL,
+                                          outdoorTemperature REAL,
+                                          setTemperature REAL,
+                                          indoorTemperature REAL,
+                                          tempDiff REAL,
+                                          heatTotal INTEGER,
+                                          coolTotal INTEGER,
+                                          heatRun INTEGER,
+                                          coolRun INTEGER,
+                                          mode TEXT,
+                                          PRIMARY KEY (device, timestamp))""")
+                connection.execute("CREATE INDEX IF NOT EXISTS samples_by_day ON samples (device, day, timestamp)")
+            cache[self.filename] = connection
+        return cache[self.filename]
+    def getRow(self, day, sample):
+        return [self.device, convert_date_to_str_YYYYMMDD_with_slash(day), sample.date + " " + sample.time] + [getattr(sample, c) for c in SqliteStore.columns]
+    def getSample(self, row):
+        # row is timestamp followed by columns
+        date, time = row[0].split(" ")
+        return Sample(date, time, *row[1:])
+    def select(self, where, args, order="timestamp"):
+        return self.getConnection().execute("SELECT timestamp, " + ", ".join(SqliteStore.columns) + " FROM samples WHERE device = ? AND " + where + " ORDER BY " + order, [self.device] + list(args)).fetchall()
+    def hasDay(self, day):
+        return self.getConnection().execute("SELECT 1 FROM samples WHERE device = ? AND day = ? LIMIT 1", (self.device, convert_date_to_str_YYYYMMDD_with_slash(day))).fetchone() is not None
+    def getDays(self):
+        rows = self.getConnection().execute("SELECT DISTINCT day FROM samples WHERE device = ?", (self.device,)).fetchall()
+        return sorted(datetime.strptime(row[0], '%Y/%m/%d').date() for row in rows)
+    def append(self, day, sample):
+        self.appendMany(day, [sample])
+    def appendMany(self, day, samples):
+        connection = self.getConnection()
+        with connection:
+            if not self.hourly:
+                connection.executemany("INSERT OR REPLACE INTO samples (device, day, timestamp, " + ", ".join(SqliteStore.columns) + ") VALUES (" + ", ".join(["?"]*(len(SqliteStore.columns) + 3)) + ")", [self.getRow(day, sample) for sample in samples])
+                return
+            # Only the first sample of an hour goes in. Checking and
+            # inserting in one statement keeps it atomic across processes.
+            rows = []
+            for sample in samples:
+                hour = sample.date + " " + sample.time.split(':')[0]
+                rows.append(self.getRow(day, sample) + [self.device, hour + ":", hour + ";"])
+            cursor = connection.executemany("INSERT INTO samples (device, day, timestamp, " + ", ".join(SqliteStore.columns) + ") SELECT " + ", ".join(["?"]*(len(SqliteStore.columns) + 3)) + " WHERE NOT EXISTS (SELECT 1 FROM samples WHERE device = ? AND timestamp >= ? AND timestamp < ?)", rows)
+            if cursor.rowcount < len(rows):
+                logger.error("Skipped " + str(len(rows) - cursor.rowcount) + " sample(s) of " + self.device + " in hours that already have one")
+    def replaceDay(self, day, samples):
+        connection = self.getConnection()
+        with connection:
+            connection.execute("DELETE FROM samples WHERE device = ? AND day = ?", (self.device, convert_date_to_str_YYYYMMDD_with_slash(day)))
+            connection.executemany("INSERT OR REPLACE INTO samples (device, day, timestamp, " + ", ".join(SqliteStore.columns) + ") VALUES (" + ", ".join(["?"]*(len(SqliteStore.columns) + 3)) + ")", [self.getRow(day, sample) for sample in samples])
+    def getLastSample(self, day):
+        rows = self.select("day = ?", [convert_date_to_str_YYYYMMDD_with_slash(day)], "timestamp DESC LIMIT 1")
+        if not rows:
+            return None
+        return self.getSample(rows[0])
+    def getDaySummaries(self, days):
+        # Everything the report needs about each day, in one query on the
+        # day index
+        days = list(days)
+        byDay = dict((convert_date_to_str_YYYYMMDD_with_slash(day), day) for day in days)
+        rows = self.getConnection().execute("""SELECT days.day, days.rows, days.minIndoor, days.maxIndoor, days.minOutdoor, days.maxOutdoor,
+                                                      samples.timestamp, """ + ", ".join("samples." + c for c in SqliteStore.columns) + """
+                                               FROM (SELECT day, COUNT(*) AS rows,
+                                                            MIN(indoorTemperature) AS minIndoor, MAX(indoorTemperature) AS maxIndoor,
+                                                            MIN(outdoorTemperature) AS minOutdoor, MAX(outdoorTemperature) AS maxOutdoor,
+                                                            MAX(timestamp) AS last
+                                                     FROM samples WHERE device = ? AND day IN (""" + ", ".join(["?"]*len(days)) + """) GROUP BY day) AS days
+                                               JOIN samples ON samples.device = ? AND samples.day = days.day AND samples.timestamp = days.last""",
+                                            [self.device] + byDay.keys() + [self.device]).fetchall()
+        summaries = dict((day, None) for day in days)
+        for row in rows:
+            summary = DaySummary()
+            summary.rows = row[1]
+            summary.indoorTemperatures = (row[2], row[3]) if row[2] is not None else None
+            summary.outdoorTemperatures = (row[4], row[5]) if row[4] is not None else None
+            summary.lastSample = self.getSample(row[6:])
+            summaries[byDay[row[0]]] = summary
+        return summaries
+    def getSamples(self, day):
+        return [self.getSample(row) for row in self.select("day = ?", [convert_date_to_str_YYYYMMDD_with_slash(day)])]
+    def getDayAsString(self, day):
+        samples = self.getSamples(day)
+        if not samples:
+            return ""
+        return first_commented_line + "\n" + "".join(format_csv_line(sample) + "\n" for sample in samples)
+    def __str__(self):
+        return "sqlite:" + self.filename + " (" + self.device + ")"
+
+captureExtension = ".capture"
+
+class CaptureStore(object):
+    # The /tstat and /tstat/datalog responses every sample was made from,
+    # with its outdoor temperature, so that it can be made again later (see
+    # replay_day). One line of JSON per sample in
+    # <fileprefix>_YYYY_MM_DD.capture, the day being that of the data file
+    # the sample went to. 'compact' packs closed days into monthly
+    # archives, <fileprefix>_YYYY_MM.capture.gz (see DayArchive), where a
+    # day of hourly captures takes a couple of kilobytes.
+    #
+    # Captures are only ever appended. Should more be appended to a day
+    # after it was archived, the day's captures are those in the archive
+    # followed by those in its file.
+    def __init__(self, filePrefix):
+        self.filePrefix = filePrefix
+        self.archives = {}
+    def getDayFile(self, day):
+        return get_datafile(self.filePrefix, day, captureExtension)
+    def getArchive(self, day):
+        filename = get_archive_file(self.filePrefix, day, captureExtension + ".gz")
+        if filename not in self.archives:
+            self.archives[filename] = DayArchive(filename)
+        return self.archives[filename]
+    def getDays(self):
+        days = set(get_days_in_files(self.filePrefix, captureExtension))
+        for filename in glob.glob(self.filePrefix + "_[0-9][0-9][0-9][0-9]_[0-9][0-9]" + captureExtension + ".gz"):
+            self.archives.setdefault(filename, DayArchive(filename))
+            days.update(self.archives[filename].getDays())
+        return sorted(days)
+    def append(self, day, capture):
+        filename = self.getDayFile(day)
+        while True:
+            f = open(filename, 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_nlink > 0:
+                break
+            # compact() archived the day while we waited for the lock
+            f.close()
+        with f:
+            os.write(f.fileno(), json.dumps(capture, separators=(',', ':'), sort_keys=True) + "\n")
+    def getDayAsString(self, day, f=None):
+        # The captures of day as text. f is the day file, if it is open.
+        archive = self.getArchive(day)
+        entry = archive.getEntry(day)
+        text = archive.read(entry) if entry is not None else ""
+        if f is not None:
+            f.seek(0)
+            return text + f.read()
+        return text + get_file_as_string(self.getDayFile(day))
+    def getCaptures(self, day):
+        captures = []
+        for line in self.getDayAsString(day).splitlines():
+            try:
+                captures.append(json.loads(line))
+            except ValueError:
+                logger.error("Skipping unreadable capture of " + convert_date_to_str_YYYYMMDD_with_slash(day) + " in " + self.filePrefix + ": " + line)
+        return captures
+    def compact(self, before):
+        # Moves the capture files of every day before the day before into
+        # their month's archive, like TextStore.compact. Returns the number
+        # of days archived.
+        byMonth = {}
+        for day in get_days_in_files(self.filePrefix, captureExtension):
+            if day < before:
+                byMonth.setdefault(get_archive_file(self.filePrefix, day, captureExtension + ".gz"), []).append(day)
+        compacted = 0
+        for filename in sorted(byMonth):
+            files = []
+            try:
+                days = []
+                for day in byMonth[filename]:
+                    f = open(self.getDayFile(day), 'rb')
+                    files.append(f)
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    days.append((day, self.getDayAsString(day, f), {}))
+                self.getArchive(byMonth[filename][0]).add(days)
+                for day in byMonth[filename]:
+                    os.remove(self.getDayFile(day))
+                compacted += len(days)
+                logger.debug("Archived " + str(len(days)) + " day(s) of captures in " + filename)
+            finally:
+                for f in files:
+                    f.close()
+        return compacted
+    def __str__(self):
+        return "captures:" + self.filePrefix
+
+storeTypes = ['text', 'binary', 'sqlite:PATH']
+
+def parse_store(value):
+    # Argparse type for --store
+    if value in ('text', 'binary') or (value.startswith('sqlite:') and len(value) > len('sqlite:')):
+        return value
+    raise argparse.ArgumentTypeError("invalid store '" + value + "', choose from " + ", ".join(storeTypes))
+
+def create_store(storeType, filePrefix, device=None, hourly=False, syncer=None):
+    # Returns None if there is nowhere to store samples. An hourly store
+    # takes one sample per hour, see is_duplicate_sample.
+    if storeType.startswith('sqlite:'):
+        return SqliteStore(get_absolute_path(storeType[len('sqlite:'):]), device, hourly)
+    if filePrefix is None:
+        return None
+    if storeType == 'binary':
+        return BinaryStore(filePrefix, hourly, syncer)
+    return TextStore(filePrefix, hourly, syncer)
+
+def is_duplicate_sample(lastSample, sample, hourly):
+    # Whether sample was already taken, e.g. by an overlapping cron run, as
+    # lastSample. Samples are appended in order, so the last one is all we
+    # need to look at. Hourly samples are the same if they are from the
+    # same hour, as a run may start anywhere within minuteOffset of it;
+    # others if they are from the same minute.
+    if lastSample is None:
+        return False
+    if hourly:
+        return lastSample.date == sample.date and lastSample.time.split(':')[0] == sample.time.split(':')[0]
+    return lastSample.date == sample.date and lastSample.time == sample.time
+
+class FileSyncer(object):
+    # When appended samples are forced to disk: 'never' leaves it to the
+    # OS, 'append' fsyncs after every append, and 'run' fsyncs every file
+    # appended to once, when flush() is called at the end of a run.
+    def __init__(self, mode='never'):
+        self.mode = mode
+        self.pending = set()
+        self.lock = threading.Lock()
+    def written(self, f):
+        if self.mode == 'append':
+            os.fsync(f.fileno())
+        elif self.mode == 'run':
+            with self.lock:
+                self.pending.add(f.name)
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = set()
+        for filename in sorted(pending):
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.error("Error syncing " + filename)
+                logger.exception(e)
+        return len(pending)
+
+def get_last_runtime(store, day):
+    sample = store.getLastSample(day)
+    if sample is None:
+        return None
+    return sample.getRuntime()
+
+def get_previous_runtime(store, day):
+    if store.hasDay(day):
+        return get_last_runtime(store, day)
+    elif not store.hourly:
+        # The first sub-hourly sample of the day has nothing before it in
+        # its file to count its runs from. Counting them from midnight
+        # would make them the day's total so far, so they are left out.
+        return None
     else:
         # If the file does not exist, this is the first log for the day at 1am
         # Runtime at midnight was nada. zip. zilch.
         return Runtime(0, 0)
 
-#Credit for the python tail method to S. Lott: http://stackoverflow.com/a/136368/215120
-def tail(f, lines=1, _buffer=4098):
-    """Tail a file and get X lines from the end"""
-    # place holder for the lines found
-    lines_found = []
-
-    # block counter will be multiplied by buffer
-    # to get the block size from the end
-    block_counter = -1
-
-    # loop until we find X lines
-    while len(lines_found) < lines:
+def convert_store(source, destination, days):
+    converted = 0
+    for day in days:
+        if not source.hasDay(day):
+            continue
+        if destination.hasDay(day):
+            logger.info("Skipping " + convert_date_to_str_YYYYMMDD_with_slash(day) + ", already in " + str(destination))
+            continue
+        destination.appendMany(day, source.getSamples(day))
+        converted += 1
+    return converted
+
+def get_captured_sample(capture):
+    # The sample capture was made from, without the columns derive_columns
+    # works out
+    sample = Sample(capture['date'], capture['time'], outdoorTemperature=capture.get('outdoor'))
+    tstat = None
+    if capture.get('tstat') is not None:
+        tstat = TstatSnapshot(capture['tstat'], capture['tstatAt'])
+        sample.setTemperature = tstat.getSetTemperature()
+        sample.indoorTemperature = tstat.temp
+        sample.mode = tstat.getMode()
+    if capture.get('datalog') is not None:
+        datalog = DatalogSnapshot(capture['datalog'], capture['datalogAt'])
+        runtime = datalog.today
+        hour, minute = sample.time.split(':')
+        if int(hour) == 0 and int(minute) <= minuteOffset:
+            # The midnight sample is the usage of the day before. If the
+            # thermostat had rolled over (see waitForRollover) that is in
+            # its yesterday bucket by now, otherwise still in today's.
+            if tstat is None:
+                runtime = None
+            elif tstat.hour < 12:
+                runtime = datalog.yesterday
+        if runtime is not None:
+            sample.heatTotal = runtime.heatRuntime
+            sample.coolTotal = runtime.coolRuntime
+    return sample
+
+def replay_samples(samples, previousRuntime):
+    # Works out the derived columns of a day's samples again, in order. The
+    # Heat Run and Cool Run of a sample are from the last sample before it
+    # that has a runtime, so one that missed its runtime no longer leaves
+    # the next without them either. A runtime lower than that one can only
+    # be a bad reading, e.g. the -1 of a midnight sample that gave up on
+    # the rollover, and gets no runs of its own.
+    #
+    # previousRuntime is what the first sample's runs are counted from:
+    # midnight's nothing for an hourly day, and for a sub-hourly one None,
+    # see get_previous_runtime.
+    for sample in samples:
+        sample.tempDiff = sample.heatRun = sample.coolRun = None
+        runtime = sample.getRuntime()
+        if runtime is not None and previousRuntime is not None and (runtime.heatRuntime < previousRuntime.heatRuntime or runtime.coolRuntime < previousRuntime.coolRuntime):
+            derive_columns(sample, None)
+            continue
+        derive_columns(sample, previousRuntime)
+        if runtime is not None:
+            previousRuntime = runtime
+    return samples
+
+def replay_day(samples, captures, hourly):
+    # A day's samples made again from their captures. Samples without a
+    # capture, e.g. from before captures were turned on, are kept as they
+    # are. Either way their derived columns are worked out again.
+    def get_slot(sample):
+        return (sample.date, sample.time.split(':')[0] if hourly else sample.time)
+    bySlot = dict((get_slot(sample), sample) for sample in samples)
+    captured = set()
+    for capture in captures:
+        sample = get_captured_sample(capture)
+        slot = get_slot(sample)
+        # Overlapping runs capture the same hour twice, while only the
+        # first one's sample was kept
+        if slot not in captured:
+            captured.add(slot)
+            bySlot[slot] = sample
+    return replay_samples([bySlot[slot] for slot in sorted(bySlot)], Runtime(0, 0) if hourly else None)
+
+def replay_worker(job):
+    # Replays one day, in a process of its own, see replay_store. Returns
+    # the day, how many of its rows changed, and if any did the values of
+    # its new samples. None rows changed if it failed.
+    storeType, filePrefix, name, hourly, day = job
+    try:
+        samples = create_store(storeType, filePrefix, name, hourly).getSamples(day)
+        before = set(format_csv_line(sample) for sample in samples)
+        samples = replay_day(samples, CaptureStore(filePrefix).getCaptures(day), hourly)
+        changed = sum(1 for sample in samples if format_csv_line(sample) not in before)
+        if not changed:
+            return day, 0, None
+        return day, changed, [tuple(getattr(sample, column) for column in Sample.__slots__) for sample in samples]
+    except Exception as e:
+        logger.error("Error replaying " + convert_date_to_str_YYYYMMDD_with_slash(day) + " of " + filePrefix)
+        logger.exception(e)
+        return day, None, None
+
+def replay_store(storeType, filePrefix, name, hourly, days, pool=None, dryRun=False):
+    # Replays days of filePrefix's store, on pool's processes if there is a
+    # pool. Days that come out the same are not written. Returns the number
+    # of days rewritten (or that would be, with dryRun) and of rows changed
+    # in them, and the number of days that failed.
+    store = create_store(storeType, filePrefix, name, hourly)
+    jobs = [(storeType, filePrefix, name, hourly, day) for day in days]
+    if pool is not None:
+        # A few days at a time, so that a short day does not cost a round
+        # trip to a process of its own
+        results = pool.imap_unordered(replay_worker, jobs, 4)
+    else:
+        results = (replay_worker(job) for job in jobs)
+    replayed, rows, failed = 0, 0, 0
+    for day, changed, samples in results:
+        if changed is None:
+            failed += 1
+            continue
+        if not changed:
+            continue
+        logger.debug(str(changed) + " row(s) of " + convert_date_to_str_YYYYMMDD_with_slash(day) + " changed in " + str(store))
+        if not dryRun:
+            store.replaceDay(day, [Sample(*values) for values in samples])
+        replayed += 1
+        rows += changed
+    return replayed, rows, failed
+
+def get_days_in_files(filePrefix, extension):
+    # Every day that has a <filePrefix>_YYYY_MM_DD<extension> file
+    days = []
+    for filename in glob.glob(filePrefix + "_[0-9][0-9][0-9][0-9]_[0-9][0-9]_[0-9][0-9]" + extension):
+        suffix = filename[len(filePrefix):-len(extension)]
+        days.append(datetime.strptime(suffix, '_%Y_%m_%d').date())
+    return sorted(days)
+
+class Follower(object):
+    # Picks up the samples appended to a prefix's data files since the last
+    # poll(). It keeps a position in every day file it follows, a byte
+    # offset for text files and a record number for binary ones, so a poll
+    # only reads what is new.
+    #
+    # The current day moves on minuteOffset after midnight (see
+    # get_current_day), but the midnight sample can still be appended to
+    # the old day file for as long as it waits for the thermostat, so the
+    # old day is followed for another rolloverBudget seconds.
+    def __init__(self, filePrefix, storeType='text', fromStart=False, clock=datetime.now):
+        self.filePrefix = filePrefix
+        self.storeType = storeType
+        self.clock = clock
+        self.positions = {}
+        day = get_current_day(clock())
+        self.positions[day] = 0 if fromStart else self.getEnd(day)
+    def getDayFile(self, day):
+        return get_datafile(self.filePrefix, day, ".bin" if self.storeType == 'binary' else ".txt")
+    def getEnd(self, day):
         try:
-            f.seek(block_counter * _buffer, os.SEEK_END)
-        except IOError:  # either file is too small, or too many lines requested
-            f.seek(0)
-            lines_found = f.readlines()
-            break
-
-        lines_found = f.readlines()
-
-        # we found enough lines, get out
-        if len(lines_found) > lines:
-            break
-
-        # decrement the block counter to get the
-        # next X bytes
-        block_counter -= 1
-
-    return lines_found[-lines:]
-
-def dump_data (tstat, filePrefix, key, url, now, email, nickname, html):
+            size = os.path.getsize(self.getDayFile(day))
+        except OSError:
+            return 0
+        if self.storeType == 'binary':
+            return max(0, (size - recordHeaderSize)/recordSize)
+        return size
+    def readText(self, day, position):
+        # Complete rows from byte position on
+        filename = self.getDayFile(day)
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return [], position
+        if size < position:
+            logger.info(filename + " shrank, reading it from the start")
+            position = 0
+        if size == position:
+            return [], position
+        with open(filename, 'rb') as f:
+            f.seek(position)
+            data = f.read(size - position)
+        # A row that is still being written is left for the next poll
+        end = data.rfind("\n") + 1
+        return parse_csv_rows(data[:end], filename), position + end
+    def readRecords(self, day, position):
+        # Records from record number position on
+        end = self.getEnd(day)
+        if end < position:
+            logger.info(self.getDayFile(day) + " shrank, reading it from the start")
+            position = 0
+        if end == position:
+            return [], position
+        return RecordFile(self.getDayFile(day)).range(position, end), end
+    def poll(self):
+        # Returns a list of (day, Sample) appended since the last poll
+        now = self.clock()
+        today = get_current_day(now)
+        if today not in self.positions:
+            self.positions[today] = 0
+        new = []
+        for day in sorted(self.positions):
+            if self.storeType == 'binary':
+                samples, self.positions[day] = self.readRecords(day, self.positions[day])
+            else:
+                samples, self.positions[day] = self.readText(day, self.positions[day])
+            new.extend((day, sample) for sample in samples)
+            dayEnd = datetime.combine(day + timedelta(1), datetime.min.time()) + timedelta(minutes=minuteOffset + 1)
+            if day != today and now > dayEnd + timedelta(seconds=rolloverBudget):
+                del self.positions[day]
+        return new
+
+def follow(filePrefix, storeType='text', fromStart=False, interval=5):
+    # Yields (day, Sample) for every sample appended to the data files of
+    # filePrefix from now on (or from the start of the current day), as
+    # they are appended, checking every interval seconds. See Follower.
+    follower = Follower(filePrefix, storeType, fromStart)
+    while True:
+        for daySample in follower.poll():
+            yield daySample
+        time.sleep(interval)
+
+def get_sample_row(day, sample):
+    # A sample as a dict for JSON, with the day of the data file it is in
+    row = dict((name, getattr(sample, name)) for name in ['date', 'time'] + SqliteStore.columns)
+    row['day'] = convert_date_to_str_YYYYMMDD_with_slash(day)
+    return row
+
+def fetch_concurrently(fetchers, metrics=None, device=None):
+    # Runs every fetcher in a thread of its own. fetchers maps a name to a
+    # (function, deadline) pair, deadline being a time.time() or None to wait
+    # for as long as it takes. Returns the results by name; a fetcher that
+    # failed or was not done by its deadline is left behind with a result of
+    # None. Its thread is a daemon and ends with its own socket timeout.
+    # Each fetcher is timed as a phase of device named after it.
+    if metrics is None:
+        metrics = Metrics()
+    results = {}
+    threads = []
+    for name, (fetch, deadline) in fetchers.items():
+        def run(name=name, fetch=fetch):
+            try:
+                with metrics.timer(device, name):
+                    results[name] = fetch()
+            except Exception as e:
+                logger.error("Error fetching " + name)
+                logger.exception(e)
+        thread = threading.Thread(target=run, name=name)
+        thread.daemon = True
+        thread.start()
+        threads.append((name, thread, deadline))
+
+    finished = {}
+    for name, thread, deadline in threads:
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            logger.error("Gave up waiting for " + name + ", leaving it out of the sample")
+            metrics.increment(device, 'late_sources')
+            finished[name] = None
+        else:
+            finished[name] = results.get(name)
+    return finished
+
+def derive_columns(sample, previousRuntime):
+    # Temp Diff, Heat Run and Cool Run of sample, from its other columns
+    # and previousRuntime, the runtime of the sample before it. Without that
+    # the runs are not known.
+    if sample.outdoorTemperature is not None and sample.setTemperature is not None:
+        # Temp diff is calculated a little differently since we want to get a sign to indicate +/-
+        sample.tempDiff = sample.outdoorTemperature - sample.setTemperature
+    runtime = sample.getRuntime()
+    if runtime is not None and previousRuntime is not None:
+        sample.heatRun = runtime.heatRuntime - previousRuntime.heatRuntime
+        sample.coolRun = runtime.coolRuntime - previousRuntime.coolRuntime
+
+def get_capture(tstat, sample):
+    # What replay_day needs to make sample again: the responses of tstat it
+    # was made from and its outdoor temperature. A response that did not
+    # come in for this sample is left out.
+    capture = {'date': sample.date, 'time': sample.time, 'outdoor': sample.outdoorTemperature}
+    for name, snapshot in (('tstat', tstat.tstatSnapshot), ('datalog', tstat.datalogSnapshot)):
+        if snapshot is not None and snapshot.isFresh(tstat.ttl):
+            capture[name] = snapshot.data
+            capture[name + 'At'] = snapshot.fetchedAt
+    return capture
+
+def dump_data (tstat, store, weather, location, now, email, nickname, html, outbox, clockOffset=None, deadline=None, captures=None, cancelled=None):
     # Get Date and Time in pretty formats for printing
     dateString = convert_date_to_str_YYYYMMDD_with_slash(now)
     timeString = convert_date_to_str_HHMM_with_colon(now)
 
-    # Get the outdoor temperature from weather underground
-    outdoorTemperature = None
-    if key is not None:
-        outdoorTemperature = get_outdoor_temperature_right_now(key, url)
-
-    # Poll the 3m50 for data
-    indoorTemperature = tstat.getCurrentIndoorTemperature()
-    desiredTemperature = tstat.getCurrentSetTemperature()
-    currentRuntime = tstat.getCurrentRuntime(now)
-    mode = tstat.getMode()
-
     # Poll stateful file for previous data
     previousRuntime = None
-    if filePrefix is not None:
-        filename = get_current_datafile(filePrefix, now)
-        previousRuntime = get_previous_runtime(filename, now)
-
-    # Temp diff is calculated a little differently since we want to get a sign to indicate +/-
-    if outdoorTemperature is None:
-        tempDiff = '--'
-    else:
-        tempDiff = '{:+}'.format(outdoorTemperature.tempImperialUnit - desiredTemperature)
-
-    csvLine = '{:>12}'.format(dateString + ",") + \
-              '{:>12}'.format(timeString + ",") + \
-              '{:>12}'.format(str(outdoorTemperature.tempImperialUnit) + "," if outdoorTemperature is not None else "--,") + \
-              '{:>12}'.format(str(desiredTemperature) + "," if desiredTemperature is not None else "--,") + \
-              '{:>12}'.format(str(indoorTemperature) + "," if indoorTemperature is not None else "--,") + \
-              '{:>12}'.format(tempDiff + ",") + \
-              '{:>12}'.format(str(currentRuntime.heatRuntime) + "," if currentRuntime is not None else "--,") + \
-              '{:>12}'.format(str(currentRuntime.coolRuntime) + ","  if currentRuntime is not None else "--,") + \
-              '{:>12}'.format(str(currentRuntime.heatRuntime - previousRuntime.heatRuntime) + "," if previousRuntime is not None else "--,") + \
-              '{:>12}'.format(str(currentRuntime.coolRuntime - previousRuntime.coolRuntime) + "," if previousRuntime is not None else "--,") +\
-              '{:>12}'.format(mode + ",") 
+    if store is not None:
+        day = get_current_day(now)
+        previousRuntime = get_previous_runtime(store, day)
+
+    # The outdoor temperature (e.g. from weather underground), /tstat and
+    # /tstat/datalog do not depend on each other, so they are fetched at the
+    # same time. Whatever is not there by the deadline is written as '--'.
+    # Only the runtime of the midnight sample may take longer, as it waits
+    # for the thermostat to roll over.
+    runtimeDeadline = deadline
+    if deadline is not None and now.hour == 0 and now.minute <= minuteOffset:
+        runtimeDeadline = deadline + rolloverBudget
+    fetchers = {
+        'tstat': (lambda: (tstat.getCurrentIndoorTemperature(), tstat.getCurrentSetTemperature(), tstat.getMode()), deadline),
+        'runtime': (lambda: tstat.getCurrentRuntime(now, clockOffset, previousRuntime), runtimeDeadline),
+    }
+    if weather is not None:
+        fetchers['weather'] = (lambda: weather.getTemperature(location), deadline)
+    results = fetch_concurrently(fetchers, tstat.metrics, tstat.hostName)
+
+    outdoorTemperature = results.get('weather')
+    indoorTemperature, desiredTemperature, mode = results['tstat'] or (None, None, None)
+    currentRuntime = results['runtime']
+
+    sample = Sample(dateString, timeString, setTemperature=desiredTemperature, indoorTemperature=indoorTemperature, mode=mode)
+    if outdoorTemperature is not None:
+        sample.outdoorTemperature = outdoorTemperature.tempImperialUnit
+    if currentRuntime is not None:
+        sample.heatTotal = currentRuntime.heatRuntime
+        sample.coolTotal = currentRuntime.coolRuntime
+    derive_columns(sample, previousRuntime)
+    csvLine = format_csv_line(sample)
+
+    # Whoever asked for the sample has given up on it, see run_fleet
+    if cancelled is not None and cancelled.is_set():
+        return sample
 
     # If a file is specified, we dump the data to the file
-    if filePrefix is not None:
+    if store is not None:
         # Dump data to data file
-        create_datafile_if_needed(filename)
-        with open(filename, "a") as myfile:
-            myfile.write(csvLine + "\n")
+        with tstat.metrics.timer(tstat.hostName, 'append'):
+            store.append(day, sample)
+        if captures is not None:
+            with tstat.metrics.timer(tstat.hostName, 'capture'):
+                captures.append(day, get_capture(tstat, sample))
     else:
         # No stateful data file, just output current stats to STDOUT
         logger.info(first_commented_line)
         logger.info(csvLine)
-        if email:
+        if email and currentRuntime is not None:
             if nickname is not None:
                 name = str(nickname)
             else:
                 name = str(tstat)
             summary = name + ': Heat runtime: ' + convertMinutesToHHMM(currentRuntime.heatRuntime) + ", Cool runtime: " + convertMinutesToHHMM (currentRuntime.coolRuntime) + " on " + dateString + " at " + timeString
-            message = create_email("rouble@gmail.com", email, summary, first_commented_line + "\n" + csvLine, html)
-            send_email(email, message)
-
-def create_email (fromH, to, subject, body, html):
-    email = "From: " + fromH + "\n"
-    email += "Subject: " + subject + "\n"
-    if body: 
-        if html:
-            email += "MIME-Version: 1.0\n"
-            email += "Content-Type: text/html\n"
-            email += get_html_body(body)
-        else:
-            email += body
-    return email
+            outbox.add(email, summary, first_commented_line + "\n" + csvLine, html)
 
-# End users may have to modify this method and customize it to send emails
-# from their systems
-def send_email (to, body):
-    try:
-        # Use the system command to send out the email
-        os.system('echo -e \"' + body + '\" | /usr/sbin/sendmail -t ' + to)
-    except Exception as e:
-        logger.exception(e)
-        logger.error("Error sending email to: " + email)
+    return sample
+
+def create_email (to, subject, body, html):
+    if body is None:
+        body = ""
+    if body and html:
+        message = MIMEText(get_html_body(body), 'html')
+    else:
+        message = MIMEText(body)
+    message['To'] = to
+    message['Subject'] = subject
+    return message
 
 def get_html_body (body):
     html = "<html>\n<body>\n<pre>\n"
@@ -396,25 +2009,140 @@ def get_html_body (body):
     html += "\n</pre>\n</body>\n</html>"
     return html
 
-def report (nickname, tstat, filePrefix, email, now, hour, html, subject):
+def get_recipients (email):
+    # The email option can hold several addresses, e.g. "a@x.com,b@x.com"
+    return [address for address in email.replace(',', ' ').split() if address]
+
+def create_digest (to, messages):
+    # One email for everything a recipient gets in a run. A single message
+    # goes out as is, several are stacked under their own subjects.
+    if len(messages) == 1:
+        subject, body, html = messages[0]
+        return create_email(to, subject, body, html)
+    subject = "3m50: " + str(len(messages)) + " reports"
+    # Failure notices have no body, so they do not decide the format
+    html = all(message[2] for message in messages if message[1])
+    if html:
+        body = "<html>\n<body>\n"
+        for message in messages:
+            body += "<h3>" + cgi.escape(message[0]) + "</h3>\n"
+            if message[1]:
+                body += "<pre>\n" + message[1] + "\n</pre>\n"
+        body += "</body>\n</html>"
+        email = MIMEText(body, 'html')
+    else:
+        body = ""
+        for message in messages:
+            body += message[0] + "\n"
+            if message[1]:
+                body += "\n" + message[1] + "\n"
+            body += "\n"
+        email = MIMEText(body)
+    email['To'] = to
+    email['Subject'] = subject
+    return email
+
+class Mailer(object):
+    # Sends emails over SMTP. Everything handed to one send() call goes
+    # through the same connection.
+    def __init__(self, hostName, port, fromAddress, timeout=60):
+        self.hostName = hostName
+        self.port = port
+        self.fromAddress = fromAddress
+        self.timeout = timeout
+    def send(self, messages):
+        if not messages:
+            return 0
+        try:
+            connection = smtplib.SMTP(self.hostName, self.port, timeout=self.timeout)
+        except (smtplib.SMTPException, socket.error) as e:
+            logger.error("Error connecting to mail server " + self.hostName + ":" + str(self.port))
+            logger.exception(e)
+            return 0
+        sent = 0
+        try:
+            for to, message in messages:
+                message['From'] = self.fromAddress
+                try:
+                    connection.sendmail(self.fromAddress, get_recipients(to), message.as_string())
+                    sent += 1
+                except smtplib.SMTPException as e:
+                    logger.error("Error sending email to: " + to)
+                    logger.exception(e)
+        except socket.error as e:
+            logger.error("Lost connection to mail server " + self.hostName + ":" + str(self.port))
+            logger.exception(e)
+        finally:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                connection.close()
+        return sent
+
+class Outbox(object):
+    # Collects the emails of a run (or of a daemon cycle) so every recipient
+    # gets one digest instead of an email per thermostat.
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+    def add(self, to, subject, body, html):
+        with self.lock:
+            self.messages.append((to, (subject, body, html)))
+    def flush(self, mailer, metrics=None):
+        if metrics is None:
+            metrics = Metrics()
+        with self.lock:
+            messages = self.messages
+            self.messages = []
+        if not messages:
+            return 0
+        byRecipient = {}
+        recipients = []
+        for to, message in messages:
+            for recipient in get_recipients(to):
+                if recipient not in byRecipient:
+                    byRecipient[recipient] = []
+                    recipients.append(recipient)
+                byRecipient[recipient].append(message)
+        emails = [(to, create_digest(to, byRecipient[to])) for to in recipients]
+        with metrics.timer(None, 'email'):
+            sent = mailer.send(emails)
+        metrics.increment(None, 'emails', sent)
+        metrics.increment(None, 'email_failures', len(emails) - sent)
+        logger.debug("Sent " + str(sent) + " of " + str(len(emails)) + " email(s) for " + str(len(messages)) + " report(s)")
+        return sent
+
+def parse_smtp(value):
+    # Argparse type for HOST[:PORT]
+    hostName, _, port = value.partition(':')
+    if not hostName:
+        raise argparse.ArgumentTypeError("invalid mail server '" + value + "', expected HOST[:PORT]")
+    if not port:
+        return (hostName, 25)
+    try:
+        return (hostName, int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid mail server port '" + port + "'")
+
+def report (nickname, tstat, store, email, now, hour, html, subject, outbox):
     if nickname is not None:
         name = str(nickname)
     else:
         name = str(tstat)
 
-    yesterdayDate = convert_date_to_str_YYYYMMDD_with_slash(now.today() - timedelta(1))
-    if now.hour == 0 and now.minute <= minuteOffset:
-        date = yesterdayDate
-    else:
-        date = convert_date_to_str_YYYYMMDD_with_slash(now.today())
-
-    current_data_file = get_current_datafile(filePrefix, now)
-    yesterdays_data_file = get_yesterdays_datafile(filePrefix, now)
+    today = get_current_day(now)
+    yesterday = get_yesterday(now)
+    date = convert_date_to_str_YYYYMMDD_with_slash(today)
+    yesterdayDate = convert_date_to_str_YYYYMMDD_with_slash(yesterday)
 
     totalHeatRuntime = 0
     totalCoolRuntime = 0
 
-    rt = get_last_runtime(current_data_file)
+    # Summaries come from the store's metadata, the raw rows are only read
+    # if they go into an email (or a verbose log).
+    summaries = store.getDaySummaries([today, yesterday])
+
+    rt = summaries[today].getRuntime() if summaries[today] is not None else None
     if rt is not None:
         totalHeatRuntime += rt.heatRuntime
         totalCoolRuntime += rt.coolRuntime
@@ -422,7 +2150,7 @@ def report (nickname, tstat, filePrefix, email, now, hour, html, subject):
     else:
         todaySummary = name + ': error getting last runtime.' 
 
-    yrt = get_last_runtime(yesterdays_data_file)
+    yrt = summaries[yesterday].getRuntime() if summaries[yesterday] is not None else None
     if yrt is not None:
         totalHeatRuntime += yrt.heatRuntime
         totalCoolRuntime += yrt.coolRuntime
@@ -432,64 +2160,191 @@ def report (nickname, tstat, filePrefix, email, now, hour, html, subject):
 
     totalSummary = name + ': Heat runtime: ' + convertMinutesToHHMM(totalHeatRuntime) + ", Cool runtime: " + convertMinutesToHHMM (totalCoolRuntime) + " on " + date
 
-    body = "Yesterday:\n" + yesterdaySummary + "\n" + get_file_as_string(yesterdays_data_file) + "\n\n" + "Today:\n" + todaySummary + "\n" + get_file_as_string(current_data_file)
+    sendEmail = email is not None and (hour is None or (now.hour == hour and now.minute <= minuteOffset))
+    if sendEmail or is_verbose():
+        body = "Yesterday:\n" + yesterdaySummary + "\n" + store.getDayAsString(yesterday) + "\n\n" + "Today:\n" + todaySummary + "\n" + store.getDayAsString(today)
 
     # Print report to STDOUT
     logger.info(todaySummary)
-    logger.info(body)
-
-    if email is not None:
-        if hour is None or (now.hour == hour and now.minute <= minuteOffset):
+    if sendEmail:
+        logger.info(body)
+    else:
+        if summaries[yesterday] is not None:
+            logger.info("Yesterday: " + str(summaries[yesterday]))
+        if summaries[today] is not None:
+            logger.info("Today: " + str(summaries[today]))
+        if is_verbose():
+            logger.debug(body)
+
+    if sendEmail:
+        summary = yesterdaySummary
+        if (subject == "yesterdays"):
             summary = yesterdaySummary
-            if (subject == "yesterdays"):
-                summary = yesterdaySummary
-            elif (subject == "todays"):
-                summary = todaySummary
-            elif (subject == "total"):
-                summary = totalSummary
-            message = create_email("rouble@gmail.com", email, summary, body, html)
-            send_email(email, message)
-
-def report_failure (nickname, tstat, email):
+        elif (subject == "todays"):
+            summary = todaySummary
+        elif (subject == "total"):
+            summary = totalSummary
+        outbox.add(email, summary, body, html)
+
+def get_failure_name (nickname, tstat):
     if nickname is not None:
         # We use a more specific name on failures.
-        name = str(nickname) + "(" + str(tstat) + ")"
-    else:
-        name = str(tstat)
+        return str(nickname) + "(" + str(tstat) + ")"
+    return str(tstat)
 
-    subject = name + " is incommunicado."
+def report_failure (nickname, tstat, email, outbox):
+    subject = get_failure_name(nickname, tstat) + " is incommunicado."
 
     # Print failure report to STDOUT
     logger.info(subject)
 
     if email is not None:
-        message = create_email("rouble@gmail.com", email, subject, None, False)
-        send_email(email, message)
+        outbox.add(email, subject, None, False)
+
+def report_recovery (nickname, tstat, email, outbox, downSince):
+    minutes = int((time.time() - downSince)/60)
+    subject = get_failure_name(nickname, tstat) + " is back after " + convertMinutesToHHMM(minutes) + "."
+
+    logger.info(subject)
+
+    if email is not None:
+        outbox.add(email, subject, None, False)
 
-def get_current_datafile(filePrefix, now):
+def get_report_days(period, end):
+    # The days a weekly report (the 7 days up to end) or a monthly report
+    # (end's month, up to end) covers
+    if period == 'week':
+        start = end - timedelta(6)
+    else:
+        start = end.replace(day=1)
+    return [start + timedelta(i) for i in xrange((end - start).days + 1)]
+
+def get_day_summaries(store, days, chunk=31):
+    # Yields (day, DaySummary or None) for days, asking the store for a
+    # chunk of days at a time
+    for i in xrange(0, len(days), chunk):
+        summaries = store.getDaySummaries(days[i:i + chunk])
+        for day in days[i:i + chunk]:
+            yield day, summaries[day]
+
+class ReportTotals(object):
+    # Runtime added up over the days of a report
+    def __init__(self):
+        self.days = 0
+        self.heatRuntime = 0
+        self.coolRuntime = 0
+    def add(self, runtime):
+        if runtime is None:
+            return
+        self.days += 1
+        self.heatRuntime += runtime.heatRuntime
+        self.coolRuntime += runtime.coolRuntime
+    def __str__(self):
+        return "Heat runtime: " + convertMinutesToHHMM(self.heatRuntime) + ", Cool runtime: " + convertMinutesToHHMM(self.coolRuntime)
+
+def format_report_range(bounds):
+    if bounds is None:
+        return "--"
+    return str(bounds[0]) + " to " + str(bounds[1])
+
+reportColumns = ['Date', 'Heat runtime', 'Cool runtime', 'Indoor', 'Outdoor', 'Samples']
+
+def get_report_row(day, summary):
+    if summary is None:
+        return [convert_date_to_str_YYYYMMDD_with_slash(day), "--", "--", "--", "--", "0"]
+    runtime = summary.getRuntime()
+    return [convert_date_to_str_YYYYMMDD_with_slash(day),
+            convertMinutesToHHMM(runtime.heatRuntime) if runtime is not None else "--",
+            convertMinutesToHHMM(runtime.coolRuntime) if runtime is not None else "--",
+            format_report_range(summary.indoorTemperatures), format_report_range(summary.outdoorTemperatures), str(summary.rows)]
+
+def get_report_total_row(name, totals):
+    return [name, convertMinutesToHHMM(totals.heatRuntime), convertMinutesToHHMM(totals.coolRuntime), "", "", str(totals.days) + " day(s)"]
+
+class TextReportWriter(object):
+    # Writes a report as it goes, one line at a time to write(line)
+    html = False
+    def __init__(self, write):
+        self.write = write
+    def writeRow(self, row):
+        self.write("".join('{:>14}'.format(column) for column in row[:3]) + "".join('{:>20}'.format(column) for column in row[3:]))
+    def begin(self, title):
+        self.write(title)
+    def beginDevice(self, name):
+        self.write("")
+        self.write(name + ":")
+        self.writeRow(reportColumns)
+    def addDay(self, day, summary):
+        self.writeRow(get_report_row(day, summary))
+    def endDevice(self, name, totals):
+        self.writeRow(get_report_total_row("Total", totals))
+    def end(self, totals):
+        self.write("")
+        self.write("All thermostats: " + str(totals))
+
+class HtmlReportWriter(TextReportWriter):
+    # The same report as a table per thermostat
+    html = True
+    def writeRow(self, row, cell='td'):
+        self.write("<tr>" + "".join("<" + cell + ">" + cgi.escape(column) + "</" + cell + ">" for column in row) + "</tr>")
+    def begin(self, title):
+        self.write("<html>")
+        self.write("<body>")
+        self.write("<h2>" + cgi.escape(title) + "</h2>")
+    def beginDevice(self, name):
+        self.write("<h3>" + cgi.escape(name) + "</h3>")
+        self.write('<table border="1" cellspacing="0" cellpadding="4">')
+        self.writeRow(reportColumns, 'th')
+    def endDevice(self, name, totals):
+        self.writeRow(get_report_total_row("Total", totals), 'th')
+        self.write("</table>")
+    def end(self, totals):
+        self.write("<p>All thermostats: " + cgi.escape(str(totals)) + "</p>")
+        self.write("</body>")
+        self.write("</html>")
+
+def write_report(writer, devices, days, title):
+    # Streams a report on devices, a list of (name, store), over days to
+    # writer. Only one day's summary is looked at at a time, so memory does
+    # not grow with the number of days or devices. Returns the totals over
+    # all devices.
+    totals = ReportTotals()
+    writer.begin(title)
+    for name, store in devices:
+        deviceTotals = ReportTotals()
+        writer.beginDevice(name)
+        for day, summary in get_day_summaries(store, days):
+            runtime = summary.getRuntime() if summary is not None else None
+            deviceTotals.add(runtime)
+            totals.add(runtime)
+            writer.addDay(day, summary)
+        writer.endDevice(name, deviceTotals)
+    writer.end(totals)
+    return totals
+
+def get_current_day(now):
     if now.hour == 0 and now.minute <= minuteOffset:
         # We write all data to files suffixed with _YYYY_MM_DD. So, every day's 
         # data is in a separate file.
         # 
         # At midnight, the current data file is yesterday's data file. This
         # is because the last reading for the day happens at midnight.
-        suffix = convert_date_to_str_YYYYMMDD_with_underscore(now.today() - timedelta(1))
-    else:
-        suffix = convert_date_to_str_YYYYMMDD_with_underscore(now)
-    return filePrefix + suffix + ".txt"
-
-def get_yesterdays_datafile(filePrefix, now):
-    if now.hour == 0 and now.minute <= minuteOffset:
-        # We write all data to files suffixed with _YYYY_MM_DD. So, every day's 
-        # data is in a separate file.  
-        #
-        # At midnight, the current data file is yesterday's data file. So,
-        # at midnight, yesterday's datafile is day before yesterday's
-        # data file.
-        suffix = convert_date_to_str_YYYYMMDD_with_underscore(now.today() - timedelta(2))
-    else:
-        suffix = convert_date_to_str_YYYYMMDD_with_underscore(now.today() - timedelta(1))
-    return filePrefix + suffix + ".txt"
+        return now.date() - timedelta(1)
+    return now.date()
+
+def get_yesterday(now):
+    # At midnight, the current data file is yesterday's data file. So, at
+    # midnight, yesterday's datafile is day before yesterday's data file.
+    return get_current_day(now) - timedelta(1)
+
+def write_file_over(filename, data):
+    # Replaces filename with data, which is on disk before it is renamed
+    # into place, so that the file is either the old or the new one
+    with open(filename + ".tmp", 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(filename + ".tmp", filename)
 
 def get_file_as_string (filename):
     try:
@@ -535,21 +2390,1320 @@ def setupLogger (logfile, verbose):
         # add the file handler to the logger
         logger.addHandler(filehandler)
 
+def is_verbose ():
+    # True if some log handler shows debug messages, i.e. --verbose was set
+    return any(handler.level <= logging.DEBUG for handler in logger.handlers)
+
 def get_absolute_path (path):
     if path is None:
         return path
     return os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
 
+# Keys a thermostat entry can have, both on the command line and in a fleet
+# config file.
+deviceKeys = ['tstat', 'nickname', 'fileprefix', 'email', 'hour', 'nohtml', 'subject', 'sync', 'sync_threshold', 'url']
+
+def get_device_from_args(args):
+    device = {}
+    for k in deviceKeys:
+        device[k] = args[k]
+    device['fileprefix'] = get_absolute_path(device['fileprefix'])
+    return device
+
+# A fleet config is a JSON file listing thermostats, e.g.
+#
+# {
+#     "key": "4XXXXXXXX",
+#     "url": "/q/NC/Cary.json",
+#     "thermostats": [
+#         {"tstat": "192.168.1.22", "nickname": "1stFloor", "fileprefix": "/some/path/first_floor", "email": "rxxxxx@xxail.com", "hour": 10},
+#         {"tstat": "192.168.1.23", "nickname": "2ndFloor", "fileprefix": "/some/path/second_floor"}
+#     ]
+# }
+#
+# Any key not set for a thermostat falls back to the value given on the
+# command line. The url (the weather location) can also be set per
+# thermostat.
+def load_fleet(filename, args):
+    with open(filename) as f:
+        config = json.load(f)
+
+    devices = []
+    for entry in config['thermostats']:
+        device = get_device_from_args(args)
+        device['url'] = config.get('url', device['url'])
+        for k in deviceKeys:
+            if k in entry:
+                device[k] = entry[k]
+        if device['tstat'] is None:
+            raise ValueError("Thermostat entry in " + filename + " has no tstat: " + json.dumps(entry))
+        device['fileprefix'] = get_absolute_path(device['fileprefix'])
+        devices.append(device)
+
+    return config.get('key', args['key']), devices
+
+# Historical analysis. Data files are loaded into numpy column arrays, one
+# array per column of first_commented_line, with NaN wherever the file
+# says '--'. Every aggregation below works on whole columns at once.
+columnNames = ['year', 'month', 'dayOfMonth', 'hour', 'minute', 'outdoorTemperature', 'setTemperature', 'indoorTemperature', 'tempDiff', 'heatTotal', 'coolTotal', 'heatRun', 'coolRun', 'mode']
+valueColumnNames = columnNames[5:13]
+
+def get_text_row_dtype():
+    # A data row is 11 columns of 11 right aligned characters and a comma,
+    # followed by a newline.
+    fields = []
+    for i in range(11):
+        fields.append(('column' + str(i), 'S11'))
+        fields.append(('comma' + str(i), 'S1'))
+    fields.append(('newline', 'S1'))
+    return numpy.dtype(fields)
+
+def get_record_dtype():
+    # The same layout as recordFormat
+    return numpy.dtype([('year', '<u2'), ('month', 'u1'), ('dayOfMonth', 'u1'), ('hour', 'u1'), ('minute', 'u1'),
+                        ('outdoorTemperature', '<f8'), ('setTemperature', '<f8'), ('indoorTemperature', '<f8'), ('tempDiff', '<f8'),
+                        ('heatTotal', '<i4'), ('coolTotal', '<i4'), ('heatRun', '<i4'), ('coolRun', '<i4'),
+                        ('mode', 'u1'), ('ints', 'u1')])
+
+def get_digits(column):
+    # The characters of a fixed width bytes column as a 2D array of digits
+    width = column.dtype.itemsize
+    return numpy.frombuffer(column.tobytes(), dtype=numpy.uint8).reshape(-1, width).astype(numpy.int32) - ord('0')
+
+def get_numbers(column):
+    missing = column == '{:>11}'.format('--')
+    return numpy.where(missing, 'nan', column).astype(numpy.float64)
+
+def get_modes(column):
+    modes = numpy.zeros(len(column), dtype=numpy.uint8)
+    for code, mode in enumerate(recordModes):
+        if mode is not None:
+            modes[column == '{:>11}'.format(mode)] = code
+    return modes
+
+def get_empty_columns():
+    return dict((name, numpy.zeros(0)) for name in columnNames)
+
+def load_text_columns(data):
+    # data is the text of a day file
+    rowDtype = get_text_row_dtype()
+    if len(data) % rowDtype.itemsize != 0:
+        # Some row is not in the fixed width layout, e.g. a temperature that
+        # needed more than 11 characters. Go the slow way.
+        return load_samples_columns(parse_csv_rows(data))
+    rows = numpy.frombuffer(data, dtype=rowDtype)
+    rows = rows[rows['column0'] != '{:>11}'.format('#      Date')]
+
+    date = get_digits(rows['column0'])
+    time = get_digits(rows['column1'])
+    columns = {
+        'year': date[:, 1]*1000 + date[:, 2]*100 + date[:, 3]*10 + date[:, 4],
+        'month': date[:, 6]*10 + date[:, 7],
+        'dayOfMonth': date[:, 9]*10 + date[:, 10],
+        'hour': time[:, 6]*10 + time[:, 7],
+        'minute': time[:, 9]*10 + time[:, 10],
+        'mode': get_modes(rows['column10']),
+    }
+    for i, name in enumerate(valueColumnNames):
+        columns[name] = get_numbers(rows['column' + str(i + 2)])
+    return columns
+
+def load_record_columns(filename):
+    with open(filename, 'rb') as f:
+        records = numpy.frombuffer(f.read(), dtype=get_record_dtype(), offset=recordHeaderSize)
+    columns = {}
+    for name in columnNames:
+        columns[name] = records[name].astype(numpy.float64 if name in valueColumnNames else numpy.int32)
+    for name in ['heatTotal', 'coolTotal', 'heatRun', 'coolRun']:
+        columns[name][records[name] == recordMissingInt] = numpy.nan
+    return columns
+
+def load_samples_columns(samples):
+    # The slow path, for anything that is not a plain fixed width file
+    rows = []
+    for sample in samples:
+        if sample is None:
+            continue
+        year, month, dayOfMonth = [int(x) for x in sample.date.split('/')]
+        hour, minute = [int(x) for x in sample.time.split(':')]
+        mode = recordModes.index(sample.mode) if sample.mode in recordModes else recordModes.index('UNKNOWN')
+        rows.append([year, month, dayOfMonth, hour, minute] + [numpy.nan if getattr(sample, name) is None else getattr(sample, name) for name in valueColumnNames] + [mode])
+    if not rows:
+        return get_empty_columns()
+    table = numpy.array(rows, dtype=numpy.float64)
+    columns = {}
+    for i, name in enumerate(columnNames):
+        columns[name] = table[:, i] if name in valueColumnNames else table[:, i].astype(numpy.int32)
+    return columns
+
+def load_columns(filePrefixes, storeType, start, end):
+    # Loads every day from start to end (inclusive) for every prefix. The
+    # returned columns have an extra 'device' column, an index into
+    # filePrefixes.
+    parts = []
+    for device, filePrefix in enumerate(filePrefixes):
+        store = create_store(storeType, filePrefix)
+        for day in store.getDays():
+            if day < start or day > end:
+                continue
+            if storeType == 'binary':
+                columns = load_record_columns(store.getDayFile(day))
+            else:
+                # Archived days are decompressed on the fly
+                columns = load_text_columns(store.getDayAsString(day))
+            columns['device'] = numpy.zeros(len(columns['year']), dtype=numpy.int32) + device
+            parts.append(columns)
+    if not parts:
+        columns = get_empty_columns()
+        columns['device'] = numpy.zeros(0, dtype=numpy.int32)
+        return columns
+    return dict((name, numpy.concatenate([part[name] for part in parts])) for name in columnNames + ['device'])
+
+seasonNames = ['Winter', 'Spring', 'Summer', 'Fall']
+
+def get_group_keys(columns, by, deviceNames):
+    # Returns a key per row and a function naming a key
+    if by == 'device':
+        return columns['device'], lambda key: deviceNames[key]
+    if by == 'season':
+        # December counts towards the next year's winter
+        season = (columns['month'] % 12)/3
+        year = columns['year'] + (columns['month'] == 12)
+        return year*4 + season, lambda key: seasonNames[key % 4] + " " + str(key/4)
+    return columns['year']*100 + columns['month'], lambda key: '{:04}/{:02}'.format(key/100, key % 100)
+
+def sum_by_group(groups, values, count):
+    # Sums values per group, ignoring NaN
+    valid = ~numpy.isnan(values)
+    return numpy.bincount(groups[valid], weights=values[valid], minlength=count)
+
+def fit_line(x, y):
+    # Least squares y = slope*x + intercept over the rows where both are
+    # known. Returns (slope, intercept, r squared), NaN if there is too
+    # little to fit.
+    valid = ~(numpy.isnan(x) | numpy.isnan(y))
+    x = x[valid]
+    y = y[valid]
+    if len(x) < 2 or numpy.all(x == x[0]):
+        return (numpy.nan, numpy.nan, numpy.nan)
+    slope, intercept = numpy.polyfit(x, y, 1)
+    residual = numpy.sum((y - (slope*x + intercept))**2)
+    total = numpy.sum((y - numpy.mean(y))**2)
+    rSquared = 1 - residual/total if total > 0 else numpy.nan
+    return (slope, intercept, rSquared)
+
+def format_number(value, formatter='{:.1f}'):
+    if value is None or numpy.isnan(value):
+        return '--'
+    return formatter.format(value)
+
+def analyze(columns, by, deviceNames):
+    if len(columns['year']) == 0:
+        logger.info("No data to analyze.")
+        return
+
+    keys, nameOf = get_group_keys(columns, by, deviceNames)
+    groupKeys, groups = numpy.unique(keys, return_inverse=True)
+    count = len(groupKeys)
+
+    heatRun = columns['heatRun']
+    coolRun = columns['coolRun']
+    outdoor = columns['outdoorTemperature']
+    indoor = columns['indoorTemperature']
+    setTemperature = columns['setTemperature']
+
+    # Runtime per degree of indoor/outdoor difference, in minutes per
+    # degree hour. Only rows where all of it is known count.
+    difference = numpy.abs(indoor - outdoor)
+    runtime = heatRun + coolRun
+    known = ~(numpy.isnan(difference) | numpy.isnan(runtime))
+    knownDifference = numpy.where(known, difference, numpy.nan)
+    knownRuntime = numpy.where(known, runtime, numpy.nan)
+    differenceSums = sum_by_group(groups, knownDifference, count)
+    runtimeSums = sum_by_group(groups, knownRuntime, count)
+
+    heatSums = sum_by_group(groups, heatRun, count)
+    coolSums = sum_by_group(groups, coolRun, count)
+    samples = numpy.bincount(groups, minlength=count)
+    outdoorSums = sum_by_group(groups, outdoor, count)
+    outdoorCounts = numpy.bincount(groups[~numpy.isnan(outdoor)], minlength=count)
+
+    # Heating and cooling degree hours against the set temperature
+    heatingDegrees = numpy.maximum(setTemperature - outdoor, 0)
+    coolingDegrees = numpy.maximum(outdoor - setTemperature, 0)
+
+    logger.info('{:>16}{:>10}{:>12}{:>12}{:>12}{:>14}{:>22}{:>22}'.format('Period', 'Samples', 'Heat', 'Cool', 'Out Temp', 'Min/Degree', 'Heat Min/Degree Hour', 'Cool Min/Degree Hour'))
+    for g in range(count):
+        rows = groups == g
+        heatFit = fit_line(heatingDegrees[rows], heatRun[rows])
+        coolFit = fit_line(coolingDegrees[rows], coolRun[rows])
+        logger.info('{:>16}{:>10}{:>12}{:>12}{:>12}{:>14}{:>22}{:>22}'.format(
+            nameOf(groupKeys[g]),
+            samples[g],
+            convertMinutesToHHMM(int(heatSums[g])),
+            convertMinutesToHHMM(int(coolSums[g])),
+            format_number(outdoorSums[g]/outdoorCounts[g] if outdoorCounts[g] else numpy.nan),
+            format_number(runtimeSums[g]/differenceSums[g] if differenceSums[g] else numpy.nan, '{:.2f}'),
+            format_number(heatFit[0], '{:.2f}') + " (r2 " + format_number(heatFit[2], '{:.2f}') + ")",
+            format_number(coolFit[0], '{:.2f}') + " (r2 " + format_number(coolFit[2], '{:.2f}') + ")"))
+
+    # Duty cycle by hour of day. A row at HH:00 holds the usage of the hour
+    # before it, so the midnight row is the 23:00 hour.
+    hourOfDay = (columns['hour'] - 1) % 24
+    hourSamples = numpy.bincount(hourOfDay[~numpy.isnan(runtime)], minlength=24)
+    hourHeat = sum_by_group(hourOfDay, heatRun, 24)
+    hourCool = sum_by_group(hourOfDay, coolRun, 24)
+    logger.info("")
+    logger.info('{:>16}{:>10}{:>12}{:>12}'.format('Hour', 'Samples', 'Heat %', 'Cool %'))
+    for hour in range(24):
+        minutes = hourSamples[hour]*60.0
+        logger.info('{:>16}{:>10}{:>12}{:>12}'.format(
+            '{:02}:00-{:02}:00'.format(hour, (hour + 1) % 24),
+            hourSamples[hour],
+            format_number(100*hourHeat[hour]/minutes if minutes else numpy.nan),
+            format_number(100*hourCool[hour]/minutes if minutes else numpy.nan)))
+
+class DeviceState(object):
+    # A small JSON document of things we learn about a device and want to
+    # remember between runs, e.g. its clock offset. It is kept next to the
+    # device's data files in <fileprefix>.state. Without a fileprefix it only
+    # lives as long as the process.
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+        self.lock = threading.Lock()
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    self.data = json.load(f)
+            except Exception as e:
+                logger.error("Ignoring unreadable device state in " + filename)
+                logger.exception(e)
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+    def isSaved(self):
+        return self.filename is not None
+    def save(self):
+        if self.filename is None:
+            return
+        with self.lock:
+            try:
+                # Write a temp file and rename it over the old one, so an
+                # interrupted run never leaves a half written state file.
+                tmpname = self.filename + ".tmp"
+                with open(tmpname, 'w') as f:
+                    json.dump(self.data, f, indent=4, sort_keys=True)
+                os.rename(tmpname, self.filename)
+            except Exception as e:
+                logger.error("Error saving device state to " + self.filename)
+                logger.exception(e)
+
+def get_state_file(filePrefix):
+    if filePrefix is None:
+        return None
+    return filePrefix + ".state"
+
+def update_clock_offset(state, snapshot):
+    # Narrows down the device's clock offset with a new measurement and
+    # returns the (low, high) window it is known to be in, in seconds.
+    low, high = snapshot.getClockOffsetWindow()
+    previous = state.get('clockOffset')
+    if previous is not None:
+        drift = clockDriftPerHour * abs(snapshot.clockReadAt - previous['measuredAt'])/3600.0
+        previousLow = previous['low'] - drift
+        previousHigh = previous['high'] + drift
+        if previousLow < high and low < previousHigh:
+            low = max(low, previousLow)
+            high = min(high, previousHigh)
+        else:
+            # The windows do not overlap, so somebody changed the clock.
+            logger.info("Thermostat clock was changed, measuring its offset from scratch")
+    state.set('clockOffset', {'low': low, 'high': high, 'measuredAt': snapshot.clockReadAt})
+    return (low, high)
+
+# The last skewHistorySize clock offsets measured, two weeks of hourly
+# samples, are kept in the device state. A clock that drifts is what makes
+# midnight samples wait for, or miss, the thermostat's rollover.
+skewHistorySize = 14*24
+
+def record_skew(state, snapshot, clockOffset):
+    history = state.get('skew', [])
+    history.append({'at': snapshot.clockReadAt, 'low': clockOffset[0], 'high': clockOffset[1], 'roundTrip': snapshot.roundTrip, 'corrected': False})
+    state.set('skew', history[-skewHistorySize:])
+
+def get_clock_drift(history):
+    # Seconds per day the clock gained (or lost, if negative) since it was
+    # last set, from the middle of the first and last windows. None until
+    # there are a few hours to go by.
+    since = 0
+    for i, entry in enumerate(history):
+        if entry['corrected']:
+            since = i + 1
+    history = history[since:]
+    if len(history) < 2 or history[-1]['at'] - history[0]['at'] < 6*60*60:
+        return None
+    first, last = history[0], history[-1]
+    change = (last['low'] + last['high'])/2.0 - (first['low'] + first['high'])/2.0
+    return change*24*60*60/(last['at'] - first['at'])
+
+def sync_clock(thermostat, state, clockOffset, threshold, metrics=None):
+    # Sets the thermostat's clock if the middle of its offset window
+    # clockOffset is off by more than threshold seconds. The window is about
+    # as wide as the minute the thermostat reports, so waiting for all of it
+    # to be past the threshold would leave a clock a minute off. Returns
+    # whether it set the clock, which also marks the last skew measurement
+    # as the one it was set after.
+    low, high = clockOffset
+    if abs((low + high)/2.0) <= threshold:
+        return False
+    drift = get_clock_drift(state.get('skew', []))
+    logger.info(thermostat.hostName + "'s clock is off by " + str(int(low)) + " to " + str(int(high)) + " seconds" +
+                ("" if drift is None else ", drifting " + '{:+.1f}'.format(drift) + " seconds a day"))
+    window = thermostat.syncTime()
+    if window is None:
+        return False
+    state.set('clockOffset', {'low': window[0], 'high': window[1], 'measuredAt': time.time()})
+    history = state.get('skew', [])
+    if history:
+        state.set('skew', history[:-1] + [dict(history[-1], corrected=True)])
+    if metrics is not None:
+        metrics.increment(thermostat.hostName, 'clock_corrections')
+    return True
+
+class DeviceHealth(object):
+    # A circuit breaker over a device's DeviceState, so that whether the
+    # device is up or down, and when to probe it next, is remembered between
+    # runs. recordFailure and recordSuccess return True when the device goes
+    # down or comes back, which is when its owner hears about it. Without a
+    # state file failures are not counted across runs, so the first one
+    # takes the device down; otherwise a dead device would never be
+    # reported.
+    def __init__(self, state):
+        self.state = state
+    def get(self):
+        return self.state.get('health') or {'up': True, 'failures': 0}
+    def isUp(self):
+        return self.get()['up']
+    def isProbeDue(self, now):
+        health = self.get()
+        return health['up'] or now >= health['nextProbe'] - probeSlack
+    def recordFailure(self, now):
+        health = dict(self.get())
+        health['failures'] += 1
+        wentDown = health['up'] and health['failures'] >= (downFailures if self.state.isSaved() else 1)
+        if wentDown:
+            health.update({'up': False, 'downSince': now, 'backoff': probeBackoff})
+        elif not health['up']:
+            health['backoff'] = min(health['backoff']*2, probeMaxBackoff)
+        if not health['up']:
+            health['nextProbe'] = now + health['backoff']
+        self.state.set('health', health)
+        return wentDown
+    def recordSuccess(self, now):
+        health = self.get()
+        self.state.set('health', {'up': True, 'failures': 0})
+        return not health['up']
+
+class SampleBuffer(object):
+    # The latest samples of every device, at most size of them each, and a
+    # summary of each device's current day, so that the read API can answer
+    # from memory. The poller adds to it and the API's threads read from it.
+    def __init__(self, size):
+        self.size = size
+        self.samples = {}
+        self.summaries = {}
+        self.lock = threading.Lock()
+    def add(self, name, day, sample, hourly=True):
+        # Every sample is one of the latest, but only hourly ones count
+        # towards the day's summary, like in the data files.
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.size)
+            self.samples[name].append((day, sample))
+            if not hourly:
+                return
+            if name not in self.summaries or self.summaries[name][0] != day:
+                self.summaries[name] = (day, DaySummary())
+            self.summaries[name][1].add(sample)
+    def seed(self, name, day, samples, summary):
+        # Starts a device off with what is already stored for day
+        with self.lock:
+            self.samples[name] = collections.deque(((day, sample) for sample in samples), maxlen=self.size)
+            self.summaries[name] = (day, summary if summary is not None else DaySummary())
+    def getNames(self):
+        with self.lock:
+            return sorted(self.samples.keys())
+    def getLatest(self, name, count=None):
+        # The last count (day, Sample) of name, oldest first
+        with self.lock:
+            samples = list(self.samples.get(name, []))
+        if count is not None:
+            samples = samples[len(samples) - min(count, len(samples)):]
+        return samples
+    def getSummary(self, name, day):
+        # The summary of name's day, which is empty until a sample of it
+        # comes in
+        with self.lock:
+            if name in self.summaries and self.summaries[name][0] == day:
+                return self.summaries[name][1]
+        return DaySummary()
+
+class Session(object):
+    # State that outlives a single poll. In daemon mode the same session is
+    # used for every cycle, so thermostats keep their snapshots' HTTP
+    # connections open. All thermostats share the session's outdoor
+    # temperature provider and its cache. Emails are held in the session's
+    # outbox, and timings and counters are collected in its metrics, until
+    # finishRun() is called at the end of a run or cycle.
+    # Collecting a sample may take up to budget seconds. Samples are also
+    # kept in memory if the session has a SampleBuffer, and with capture the
+    # responses they were made from are kept next to the data files.
+    def __init__(self, weather, timeout, storeType='text', mailer=None, budget=None, metrics=None, syncer=None, samples=None, capture=False):
+        self.weather = weather
+        self.timeout = timeout
+        self.budget = budget
+        self.storeType = storeType
+        self.syncer = syncer if syncer is not None else FileSyncer()
+        self.mailer = mailer
+        self.outbox = Outbox()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.samples = samples
+        self.capture = capture
+        self.thermostats = {}
+        self.deviceStates = {}
+        self.lastHourlySample = {}
+        self.abandoned = {}
+        self.lock = threading.Lock()
+    def getThermostat(self, hostName):
+        with self.lock:
+            if hostName not in self.thermostats:
+                self.thermostats[hostName] = Thermostat(hostName, timeout=self.timeout, metrics=self.metrics)
+            return self.thermostats[hostName]
+    def getStore(self, device, detail=False):
+        # Sub-hourly samples are kept apart from the hourly ones, see
+        # get_detail_fileprefix.
+        filePrefix = device['fileprefix']
+        name = get_device_name(device)
+        if detail:
+            filePrefix = get_detail_fileprefix(filePrefix)
+            name = get_detail_fileprefix(name)
+        return create_store(self.storeType, filePrefix, name, not detail, self.syncer)
+    def getCaptureStore(self, device, detail=False):
+        # None unless capturing, which needs a file prefix whatever the store
+        filePrefix = device['fileprefix']
+        if not self.capture or filePrefix is None:
+            return None
+        return CaptureStore(get_detail_fileprefix(filePrefix) if detail else filePrefix)
+    def getDeviceState(self, device):
+        with self.lock:
+            if device['tstat'] not in self.deviceStates:
+                self.deviceStates[device['tstat']] = DeviceState(get_state_file(device['fileprefix']))
+            return self.deviceStates[device['tstat']]
+    def finishRun(self):
+        # Syncs the data files written to, sends the emails of the run and
+        # exports its metrics
+        with self.metrics.timer(None, 'fsync'):
+            self.syncer.flush()
+        if self.mailer is not None:
+            self.outbox.flush(self.mailer, self.metrics)
+        self.metrics.export()
+    def addSample(self, device, now, sample, hourly=True):
+        if self.samples is not None and sample is not None:
+            self.samples.add(get_device_name(device), get_current_day(now), sample, hourly)
+    def isHourlySampleDue(self, hostName, now):
+        # The hourly row is written by the first sample within minuteOffset
+        # of the top of the hour that gets appended, see markHourlySample.
+        # Every other sample in that hour is a sub-hourly one.
+        if now.minute > minuteOffset:
+            return False
+        with self.lock:
+            return self.lastHourlySample.get(hostName) != now.replace(minute=0, second=0, microsecond=0)
+    def markHourlySample(self, hostName, now):
+        # Only once the hourly sample is in, so that a poll that failed is
+        # tried again within minuteOffset
+        with self.lock:
+            self.lastHourlySample[hostName] = now.replace(minute=0, second=0, microsecond=0)
+
+def get_device_name(device):
+    if device['nickname'] is not None:
+        return str(device['nickname'])
+    return str(device['tstat'])
+
+def get_detail_fileprefix(filePrefix):
+    # Sub-hourly samples go to their own daily files, so the hourly files
+    # and the Heat Run/Cool Run deltas in them keep their meaning.
+    if filePrefix is None:
+        return None
+    return filePrefix + "_detail"
+
+def poll_thermostat(session, device, now, hourly=True, cancelled=None):
+    # With cancelled, an Event, nothing is written once it is set, see
+    # run_fleet. Returns False then.
+    def isCancelled():
+        return cancelled is not None and cancelled.is_set()
+    thermostat = session.getThermostat(device['tstat'])
+    html = not device['nohtml']
+    deadline = None
+    if session.budget is not None:
+        deadline = time.time() + session.budget
+
+    # A thermostat that is down is only probed now and then, until it
+    # answers again. Every other poll gives up on it right away.
+    state = session.getDeviceState(device)
+    health = DeviceHealth(state)
+    startedAt = time.time()
+    if not health.isProbeDue(startedAt):
+        session.metrics.increment(device['tstat'], 'skipped')
+        logger.debug("Skipping " + device['tstat'] + ", it is down until a probe at " + convert_date_to_str_HHMM_with_colon(datetime.fromtimestamp(health.get()['nextProbe'])))
+        return False
+
+    # Every poll is a new sample, so start from fresh snapshots even if the
+    # thermostat object (and its connection) is reused from an earlier cycle.
+    thermostat.invalidate()
+
+    # Test if the thermostat is up
+    if thermostat.isUp() == False:
+        if isCancelled():
+            return False
+        session.metrics.increment(device['tstat'], 'unreachable')
+        # Send failure email only when the thermostat goes down, not on
+        # every poll that finds it still down
+        if health.recordFailure(startedAt):
+            report_failure(device['nickname'], device['tstat'], device['email'], session.outbox)
+        state.save()
+        return False
+    if isCancelled():
+        return False
+    downSince = health.get().get('downSince')
+    if health.recordSuccess(time.time()):
+        report_recovery(device['nickname'], device['tstat'], device['email'], session.outbox, downSince)
+
+    # Every /tstat tells us a little more about the thermostat's clock
+    clockOffset = update_clock_offset(state, thermostat.getTstatSnapshot())
+    state.save()
+
+    session.metrics.increment(device['tstat'], 'samples')
+    if not hourly:
+        sample = dump_data(thermostat, session.getStore(device, detail=True), session.weather, device['url'], now, None, device['nickname'], html, session.outbox, clockOffset, deadline, session.getCaptureStore(device, detail=True), cancelled)
+        if isCancelled():
+            return False
+        session.addSample(device, now, sample, hourly=False)
+        return True
+
+    # Collect current data from 3m50 and dump it to the file
+    store = session.getStore(device)
+    sample = dump_data(thermostat, store, session.weather, device['url'], now, device['email'], device['nickname'], html, session.outbox, clockOffset, deadline, session.getCaptureStore(device), cancelled)
+    if isCancelled():
+        return False
+    session.markHourlySample(device['tstat'], now)
+    session.addSample(device, now, sample)
+
+    # Print report to STDOUT and also email if necessary
+    if store is not None:
+        with session.metrics.timer(device['tstat'], 'report'):
+            report(device['nickname'], device['tstat'], store, device['email'], now, device['hour'], html, device['subject'], session.outbox)
+    #else: dump_data takes care of sending an email if there are no stateful files.
+
+    # Every hourly sample goes into the clock's skew history. Setting the
+    # clock takes up to a minute, so it is left to sync_clocks, after the
+    # whole fleet has been sampled.
+    snapshot = thermostat.tstatSnapshot
+    if isCancelled():
+        return False
+    if snapshot is not None:
+        record_skew(state, snapshot, clockOffset)
+    state.save()
+
+    return True
+
+def sync_clocks(session, devices, now, workers):
+    # Sets the clocks of the devices with --sync that are off by more than
+    # their threshold, on at most workers threads. It runs after sampling,
+    # outside of run_fleet's per-device timeout, as syncTime waits for the
+    # host's clock to turn to the next minute. devices should be the ones
+    # whose hourly sample was just taken. No clock is set around midnight,
+    # as the midnight sample depends on the clock staying put until the
+    # thermostat has rolled over.
+    #
+    # The window of a clock's offset is about a minute wide, as wide as the
+    # minute the thermostat reports. If that leaves open whether the clock
+    # is within the threshold, the clock is read once more, half a minute
+    # after the sample read it. That halves the window, so its middle is
+    # off by at most a quarter of a minute.
+    if now.hour == 0 and now.minute <= minuteOffset:
+        return
+    pending = [device for device in devices if device['sync']]
+    running = []
+
+    def worker(device):
+        try:
+            state = session.getDeviceState(device)
+            clockOffset = state.get('clockOffset')
+            if clockOffset is None:
+                return
+            thermostat = session.getThermostat(device['tstat'])
+            low, high = clockOffset['low'], clockOffset['high']
+            threshold = device['sync_threshold']
+            if low < threshold and -threshold < high and (low < -threshold or threshold < high):
+                time.sleep(max(0, clockOffset['measuredAt'] + 30 - time.time()))
+                thermostat.invalidate()
+                low, high = update_clock_offset(state, thermostat.getTstatSnapshot())
+            sync_clock(thermostat, state, (low, high), threshold, session.metrics)
+            state.save()
+        except Exception as e:
+            logger.error("Error setting the clock of thermostat " + device['tstat'])
+            logger.exception(e)
+
+    while pending or running:
+        while pending and len(running) < workers:
+            device = pending.pop(0)
+            thread = threading.Thread(target=worker, args=(device,), name=device['tstat'])
+            thread.daemon = True
+            thread.start()
+            running.append(thread)
+        for thread in running:
+            thread.join(0.05)
+        running = [thread for thread in running if thread.is_alive()]
+
+def run_fleet(session, devices, now, workers, hourly=None):
+    # Polls every thermostat on at most workers threads. Each device gets
+    # session.timeout seconds; a device that is still busy after that is
+    # abandoned and counted as failed so that it cannot hold up the rest of
+    # the fleet. Worker threads are daemons, so an abandoned device does not
+    # keep the process alive either. An abandoned poll is cancelled, so that
+    # it writes nothing after it was counted as failed, and the device is
+    # not polled again until its thread has finished.
+    #
+    # hourly is a function deciding whether a device's sample is its hourly
+    # one. By default every sample is.
+    timeout = session.timeout
+    if now.hour == 0 and now.minute <= minuteOffset:
+        # Leave the midnight sample time to wait for the rollover
+        timeout += rolloverBudget
+    results = {}
+    pending = list(devices)
+    running = []
+
+    def worker(device, cancelled):
+        try:
+            isHourly = hourly is None or hourly(device)
+            result = poll_thermostat(session, device, now, isHourly, cancelled)
+        except Exception as e:
+            logger.error("Error polling thermostat " + device['tstat'])
+            logger.exception(e)
+            result = False
+        if not cancelled.is_set():
+            results[device['tstat']] = result
+
+    while pending or running:
+        while pending and len(running) < workers:
+            device = pending.pop(0)
+            previous = session.abandoned.get(device['tstat'])
+            if previous is not None and previous.is_alive():
+                logger.error("Skipping thermostat " + device['tstat'] + ", an earlier poll of it is still running")
+                session.metrics.increment(device['tstat'], 'poll_timeouts')
+                results[device['tstat']] = False
+                continue
+            session.abandoned.pop(device['tstat'], None)
+            cancelled = threading.Event()
+            thread = threading.Thread(target=worker, args=(device, cancelled), name=device['tstat'])
+            thread.daemon = True
+            thread.start()
+            running.append((thread, device, time.time(), cancelled))
+
+        stillRunning = []
+        for thread, device, startedAt, cancelled in running:
+            thread.join(0.05)
+            if not thread.is_alive():
+                continue
+            if time.time() - startedAt > timeout:
+                logger.error("Timed out polling thermostat " + device['tstat'] + " after " + str(timeout) + " seconds")
+                session.metrics.increment(device['tstat'], 'poll_timeouts')
+                cancelled.set()
+                session.abandoned[device['tstat']] = thread
+                results[device['tstat']] = False
+                continue
+            stillRunning.append((thread, device, startedAt, cancelled))
+        running = stillRunning
+
+    return results
+
+def get_next_sample_time(now, interval):
+    # Samples are aligned to the top of the hour, so with a 5 minute interval
+    # we sample at :00, :05, :10 and so on. interval always divides 60.
+    start = now.replace(second=0, microsecond=0)
+    start -= timedelta(minutes=start.minute % interval)
+    return start + timedelta(minutes=interval)
+
+class AdaptiveScheduler(object):
+    # Decides when each thermostat is sampled next from what its last /tstat
+    # said: every activeInterval minutes while it heats or cools, every
+    # idleInterval minutes while it is idle, and only hourly when it is off.
+    # Samples are spread out further if needed to stay within
+    # requestsPerHour requests to the thermostat over the last hour.
+    #
+    # Every thermostat is sampled at the top of every hour regardless, so
+    # the hourly rows that reports and the Heat Run/Cool Run columns are
+    # built on are still written. Those samples do not count against
+    # requestsPerHour, and one that failed is tried again every minute
+    # while it is still due.
+    def __init__(self, activeInterval, idleInterval, requestsPerHour):
+        self.activeInterval = activeInterval
+        self.idleInterval = idleInterval
+        self.requestsPerHour = requestsPerHour
+        self.nextSample = {}
+        self.requestCounts = {}
+        self.history = {}
+    def getDueDevices(self, devices, now):
+        # Thermostats not sampled yet are due right away, to learn their state
+        return [device for device in devices if self.nextSample.get(device['tstat'], now) <= now]
+    def getInterval(self, snapshot):
+        # Minutes until the next sample and why, given the last /tstat
+        if snapshot is None:
+            return self.idleInterval, "unreachable"
+        if snapshot.tmode == 0:
+            return 60, "off"
+        if snapshot.tstate in (1, 2):
+            return self.activeInterval, "heating" if snapshot.tstate == 1 else "cooling"
+        return self.idleInterval, "idle"
+    def update(self, device, now, thermostat, hourly=False, hourlyDue=False):
+        # Schedules device's next sample after the one taken at now. hourly
+        # is whether that was the hourly sample, and hourlyDue whether the
+        # hourly sample is still due, because it failed.
+        hostName = device['tstat']
+        requestCount = thermostat.getRequestCount()
+        cost = requestCount - self.requestCounts.get(hostName, 0)
+        self.requestCounts[hostName] = requestCount
+
+        # Requests of the samples in the last hour, but for hourly ones
+        history = self.history.setdefault(hostName, collections.deque())
+        if not hourly:
+            history.append((now, cost))
+        while history and history[0][0] <= now - timedelta(hours=1):
+            history.popleft()
+        used = sum(c for t, c in history)
+
+        interval, reason = self.getInterval(thermostat.tstatSnapshot)
+        # At the average cost of a sample, the budget allows one every
+        # budgetInterval minutes
+        averageCost = float(used)/len(history) if history else cost
+        budgetInterval = 60.0*max(1, averageCost)/self.requestsPerHour
+        if budgetInterval > interval:
+            interval = int(math.ceil(budgetInterval))
+            reason += ", within budget"
+        start = now.replace(second=0, microsecond=0)
+        nextSample = start + timedelta(minutes=interval)
+        if used >= self.requestsPerHour:
+            # Spent already, wait for the oldest sample to leave the hour
+            refill = history[0][0].replace(second=0, microsecond=0) + timedelta(hours=1)
+            if refill > nextSample:
+                nextSample = refill
+                reason = "out of budget"
+        nextSample = min(nextSample, start.replace(minute=0) + timedelta(hours=1))
+        if hourlyDue:
+            nextSample = start + timedelta(minutes=1)
+            reason = "hourly sample failed"
+        self.nextSample[hostName] = nextSample
+        logger.debug("Sampling " + hostName + " next at " + convert_date_to_str_HHMM_with_colon(nextSample) + " (" + reason + ", " + str(used) + " requests in the last hour)")
+
+# Processes sharing a fleet (see LeaseKeeper) hold a thermostat for
+# leaseTTL seconds at a time and renew their leases every leaseRenewal
+# seconds. The thermostats of a process that stopped are taken over once
+# its leases run out.
+leaseTTL = 90
+leaseRenewal = 20
+
+def get_lease_name(name):
+    # name, e.g. a host name and port, as part of a file name
+    return "".join(c if c.isalnum() or c in '.-' else '_' for c in name)
+
+class LeaseKeeper(object):
+    # Shares a fleet between daemons, on one host or on several with a
+    # shared directory, so that each thermostat is polled by one of them.
+    # A daemon holds a thermostat through a lease file in directory, which
+    # it renews from a thread of its own for as long as it runs. Every daemon
+    # also keeps a heartbeat file under directory/workers, so that each can
+    # tell how many are alive and hold its share of the fleet: it lets go of
+    # leases beyond its share and claims free or expired ones below it.
+    def __init__(self, directory, devices, workerId=None):
+        self.directory = directory
+        self.devices = devices
+        self.workerId = workerId if workerId is not None else socket.gethostname() + ":" + str(os.getpid())
+        self.owned = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+    def getLeaseFile(self, device):
+        return os.path.join(self.directory, get_lease_name(device['tstat']) + ".lease")
+    def getWorkerFile(self):
+        return os.path.join(self.directory, "workers", get_lease_name(self.workerId) + ".worker")
+    def heartbeat(self, now):
+        # Written to a temp file and renamed, so others never read half of it
+        filename = self.getWorkerFile()
+        with open(filename + ".tmp", 'w') as f:
+            json.dump({'worker': self.workerId, 'expires': now + leaseTTL}, f)
+        os.rename(filename + ".tmp", filename)
+    def getLiveWorkers(self, now):
+        workers = []
+        for filename in glob.glob(os.path.join(self.directory, "workers", "*.worker")):
+            try:
+                with open(filename) as f:
+                    worker = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if worker['expires'] > now:
+                workers.append(worker['worker'])
+        return workers
+    def updateLease(self, device, now, hold):
+        # Takes or renews device's lease, or with hold False lets go of it,
+        # unless another daemon holds it. Returns whether we hold it now.
+        with open(self.getLeaseFile(device), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                lease = json.loads(f.read() or "{}")
+            except ValueError:
+                lease = {}
+            owner = lease.get('owner')
+            if owner is not None and owner != self.workerId and lease['expires'] > now:
+                return False
+            if hold:
+                if owner is not None and owner != self.workerId:
+                    logger.info("Taking over " + device['tstat'] + " from " + owner + ", whose lease ran out")
+                lease = {'owner': self.workerId, 'expires': now + leaseTTL}
+            elif owner == self.workerId:
+                lease = {}
+            else:
+                return False
+            f.truncate(0)
+            f.write(json.dumps(lease))
+            f.flush()
+            return hold
+    def balance(self):
+        # Renews our leases up to our share of the fleet, lets go of the
+        # rest and claims free ones until we have our share
+        now = time.time()
+        self.heartbeat(now)
+        workers = max(1, len(self.getLiveWorkers(now)))
+        share = int(math.ceil(len(self.devices)/float(workers)))
+        with self.lock:
+            previous = set(self.owned)
+        owned = set()
+        for device in self.devices:
+            if device['tstat'] in previous:
+                if self.updateLease(device, now, len(owned) < share):
+                    owned.add(device['tstat'])
+        for device in self.devices:
+            if len(owned) >= share:
+                break
+            if device['tstat'] not in owned and self.updateLease(device, now, True):
+                owned.add(device['tstat'])
+        if owned != previous:
+            logger.info("Polling " + str(len(owned)) + " of " + str(len(self.devices)) + " thermostat(s), shared by " + str(workers) + " process(es)" +
+                        "".join(", +" + t for t in sorted(owned - previous)) + "".join(", -" + t for t in sorted(previous - owned)))
+        with self.lock:
+            self.owned = owned
+    def run(self):
+        while not self.stopped.wait(leaseRenewal):
+            try:
+                self.balance()
+            except Exception as e:
+                logger.error("Error renewing leases in " + self.directory)
+                logger.exception(e)
+    def start(self):
+        # Claims our share right away, then keeps it from a daemon thread
+        workersDirectory = os.path.join(self.directory, "workers")
+        if not os.path.isdir(workersDirectory):
+            os.makedirs(workersDirectory)
+        self.balance()
+        thread = threading.Thread(target=self.run, name='leases')
+        thread.daemon = True
+        thread.start()
+    def stop(self):
+        # Hands our thermostats over to the others right away
+        self.stopped.set()
+        now = time.time()
+        for device in self.devices:
+            try:
+                self.updateLease(device, now, False)
+            except (IOError, OSError) as e:
+                logger.error("Error releasing the lease of " + device['tstat'])
+                logger.exception(e)
+        try:
+            os.remove(self.getWorkerFile())
+        except OSError:
+            pass
+    def getOwned(self, devices):
+        with self.lock:
+            return [device for device in devices if device['tstat'] in self.owned]
+
+def run_daemon(session, devices, workers, interval, scheduler=None, leases=None):
+    # Samples every thermostat every interval minutes, or with a scheduler
+    # checks every minute which thermostats are due. With leases only the
+    # thermostats leased to this process are sampled.
+    if leases is not None:
+        logger.info("Sharing " + str(len(devices)) + " thermostat(s) with the other processes using " + leases.directory)
+    if scheduler is None:
+        logger.info("Sampling " + str(len(devices)) + " thermostat(s) every " + str(interval) + " minute(s)")
+    else:
+        logger.info("Sampling " + str(len(devices)) + " thermostat(s) every " + str(scheduler.activeInterval) + " minute(s) while running, every " + str(scheduler.idleInterval) + " minute(s) while idle, with at most " + str(scheduler.requestsPerHour) + " requests per hour each")
+    while True:
+        nextSample = get_next_sample_time(datetime.now(), interval if scheduler is None else 1)
+        delay = (nextSample - datetime.now()).total_seconds()
+        if delay > 0:
+            time.sleep(delay)
+
+        now = datetime.now()
+        owned = devices if leases is None else leases.getOwned(devices)
+        due = owned if scheduler is None else scheduler.getDueDevices(owned, now)
+        if not due:
+            continue
+        hourly = dict((device['tstat'], session.isHourlySampleDue(device['tstat'], now)) for device in due)
+        try:
+            results = run_fleet(session, due, now, workers, lambda device: hourly[device['tstat']])
+            sync_clocks(session, [device for device in due if hourly[device['tstat']] and results.get(device['tstat'])], now, workers)
+        except Exception as e:
+            # Never let one bad cycle take the daemon down
+            logger.error("Error sampling thermostats at " + convert_date_to_str_HHMM_with_colon(now))
+            logger.exception(e)
+        if scheduler is not None:
+            nextMinute = now + timedelta(minutes=1)
+            for device in due:
+                scheduler.update(device, now, session.getThermostat(device['tstat']), hourly[device['tstat']], session.isHourlySampleDue(device['tstat'], nextMinute))
+        session.finishRun()
+
+def seed_samples(session, devices, now):
+    # Fills the session's SampleBuffer with what the stores already have of
+    # the current day, hourly and sub-hourly, so that the read API has
+    # something to show before the first cycle and after a restart.
+    day = get_current_day(now)
+    for device in devices:
+        samples = []
+        summary = None
+        try:
+            store = session.getStore(device)
+            if store is not None:
+                summary = store.getDaySummaries([day])[day]
+                for s in (store, session.getStore(device, detail=True)):
+                    if s.hasDay(day):
+                        samples += s.getSamples(day)
+        except Exception as e:
+            logger.error("Error reading today's samples of thermostat " + device['tstat'])
+            logger.exception(e)
+        samples.sort(key=lambda sample: (sample.date, sample.time))
+        session.samples.seed(get_device_name(device), day, samples[-session.samples.size:], summary)
+
+def get_summary_row(name, day, summary):
+    # A DaySummary as a dict for JSON
+    def get_bounds(bounds):
+        if bounds is None:
+            return None
+        return {'min': bounds[0], 'max': bounds[1]}
+    runtime = summary.getRuntime()
+    return {'device': name, 'day': convert_date_to_str_YYYYMMDD_with_slash(day), 'rows': summary.rows,
+            'heatRuntime': runtime.heatRuntime if runtime is not None else None,
+            'coolRuntime': runtime.coolRuntime if runtime is not None else None,
+            'indoorTemperature': get_bounds(summary.indoorTemperatures),
+            'outdoorTemperature': get_bounds(summary.outdoorTemperatures),
+            'lastSample': get_sample_row(day, summary.lastSample) if summary.lastSample is not None else None}
+
+class ReadApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Answers from the server's SampleBuffer only, never from the
+    # thermostats or the data files:
+    #
+    #   GET /devices                     every device and its latest sample
+    #   GET /devices/NAME/latest         NAME's latest sample
+    #   GET /devices/NAME/samples?n=N    NAME's last N samples, oldest first
+    #   GET /devices/NAME/today          summary of NAME's current day
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+        samples = self.server.samples
+        url = urlparse.urlparse(self.path)
+        parts = [urllib.unquote(part) for part in url.path.strip('/').split('/')]
+        if parts == ['devices']:
+            devices = []
+            for name in samples.getNames():
+                latest = samples.getLatest(name, 1)
+                devices.append({'device': name, 'latest': get_sample_row(*latest[0]) if latest else None})
+            self.sendJson(200, devices)
+            return
+        if len(parts) != 3 or parts[0] != 'devices' or parts[2] not in ('latest', 'samples', 'today'):
+            self.sendJson(404, {'error': 'Unknown path ' + url.path})
+            return
+        name = parts[1]
+        if name not in samples.getNames():
+            self.sendJson(404, {'error': 'Unknown device ' + name})
+            return
+        if parts[2] == 'latest':
+            latest = samples.getLatest(name, 1)
+            if not latest:
+                self.sendJson(404, {'error': 'No samples of ' + name + ' yet'})
+                return
+            self.sendJson(200, get_sample_row(*latest[0]))
+        elif parts[2] == 'samples':
+            count = urlparse.parse_qs(url.query).get('n', [None])[0]
+            try:
+                count = int(count) if count is not None else None
+            except ValueError:
+                count = -1
+            if count is not None and count < 0:
+                self.sendJson(400, {'error': 'n must be a number of samples'})
+                return
+            self.sendJson(200, [get_sample_row(day, sample) for day, sample in samples.getLatest(name, count)])
+        else:
+            day = get_current_day(datetime.now())
+            self.sendJson(200, get_summary_row(name, day, samples.getSummary(name, day)))
+    def sendJson(self, status, data):
+        body = json.dumps(data, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        logger.debug("Read API: " + self.address_string() + " " + (format % args))
+
+class ReadApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, samples):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReadApiHandler)
+        self.samples = samples
+
+def serve_samples(samples, address):
+    # Serves samples on address from a daemon thread, next to the poller
+    server = ReadApiServer(address, samples)
+    thread = threading.Thread(target=server.serve_forever, name='read api')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving the latest samples on http://" + address[0] + ":" + str(server.server_address[1]) + "/devices")
+    return server
+
+def parse_listen(value):
+    # Argparse type for --serve, [HOST:]PORT. Only this machine can connect
+    # unless a host is given.
+    hostName, _, port = value.rpartition(':')
+    try:
+        return (hostName or '127.0.0.1', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid address '" + value + "', expected [HOST:]PORT")
+
+def convert_main (argv):
+    parser = argparse.ArgumentParser(prog='3m50.py convert', description='Converts data files to another store, e.g. from text to binary files or into an SQLite database. Days already present in the destination are left alone.')
+    parser.add_argument('-f', '--fileprefix', help='Prefix of the data files to convert', required=True)
+    parser.add_argument('-t', '--to', help='Store to convert to', metavar='{' + ','.join(storeTypes) + '}', type=parse_store, required=True)
+    parser.add_argument('-s', '--from', help="Format of the data files to convert (Default: binary when converting to text, otherwise text)", choices=['text', 'binary'], default=None)
+    parser.add_argument('-n', '--nickname', help='Device name to store the samples under in an SQLite database (Default: the file name of the prefix)')
+    parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
+    args = vars(parser.parse_args(argv))
+
+    setupLogger(None, args['verbose'])
+
+    filePrefix = get_absolute_path(args['fileprefix'])
+    sourceType = args['from']
+    if sourceType is None:
+        sourceType = 'binary' if args['to'] == 'text' else 'text'
+    if sourceType == args['to']:
+        parser.error("nothing to convert, the data files already are " + sourceType)
+
+    source = create_store(sourceType, filePrefix)
+    nickname = args['nickname'] if args['nickname'] is not None else os.path.basename(filePrefix)
+    destination = create_store(args['to'], filePrefix, nickname)
+    converted = convert_store(source, destination, source.getDays())
+    logger.info("Converted " + str(converted) + " day(s) to " + str(destination))
+
+def compact_main (argv):
+    parser = argparse.ArgumentParser(prog='3m50.py compact', description='Packs the text data files of closed days into compressed monthly archives, <fileprefix>_YYYY_MM.txt.gz, and their captures into <fileprefix>_YYYY_MM.capture.gz. Reports, analyze, convert and replay read archived days as before.')
+    parser.add_argument('-f', '--fileprefix', help='Prefix of the data files to compact. Can be given several times', action='append', required=True)
+    parser.add_argument('-k', '--keep', help="Number of closed days to leave as they are, besides today (Default: 1, i.e. yesterday)", type=int, default=1)
+    parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
+    args = vars(parser.parse_args(argv))
+
+    setupLogger(None, args['verbose'])
+
+    before = get_current_day(datetime.now()) - timedelta(max(0, args['keep']))
+    for filePrefix in args['fileprefix']:
+        filePrefix = get_absolute_path(filePrefix)
+        compacted = TextStore(filePrefix).compact(before)
+        logger.info("Archived " + str(compacted) + " day(s) of " + filePrefix)
+        compacted = CaptureStore(filePrefix).compact(before)
+        if compacted:
+            logger.info("Archived " + str(compacted) + " day(s) of captures of " + filePrefix)
+
+def replay_main (argv):
+    parser = argparse.ArgumentParser(prog='3m50.py replay', description="Makes the samples of a range of days again from the thermostat responses captured with --capture, and works out their Temp Diff, Heat Run and Cool Run columns again, e.g. after a missed runtime or a midnight sample that gave up on the rollover. Samples without captures keep their values and only get their derived columns worked out again. Days are replayed in parallel, and only days that change are written.")
+    parser.add_argument('-f', '--fileprefix', help='Prefix of the data files to replay. Can be given several times', action='append', required=True)
+    parser.add_argument('-a', '--from', help='First day to replay, YYYY-MM-DD (Default: the first day there is data for)', type=parse_date, default=date.min)
+    parser.add_argument('-z', '--to', help='Last day to replay, YYYY-MM-DD (Default: yesterday)', type=parse_date, default=None)
+    parser.add_argument('-b', '--store', help="Store to replay into. In an SQLite database the samples are under the file name of the prefix (Default: text)", metavar='{' + ','.join(storeTypes) + '}', type=parse_store, default='text')
+    parser.add_argument('-d', '--detail', help="Replay the sub-hourly _detail samples instead of the hourly ones", action="store_true", default=False)
+    parser.add_argument('-w', '--workers', help="Number of days to replay at once (Default: number of CPUs)", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-n', '--dry-run', help="Only count the days and rows that would change", action="store_true", default=False)
+    parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
+    args = vars(parser.parse_args(argv))
+
+    setupLogger(None, args['verbose'])
+
+    end = args['to'] if args['to'] is not None else get_yesterday(datetime.now())
+    # The processes are started before any store is opened, so that none
+    # of them inherits an SQLite connection
+    pool = multiprocessing.Pool(args['workers']) if args['workers'] > 1 else None
+    failed = 0
+    try:
+        for filePrefix in args['fileprefix']:
+            filePrefix = get_absolute_path(filePrefix)
+            name = os.path.basename(filePrefix)
+            if args['detail']:
+                filePrefix = get_detail_fileprefix(filePrefix)
+                name = get_detail_fileprefix(name)
+            store = create_store(args['store'], filePrefix, name, not args['detail'])
+            days = set(store.getDays()) | set(CaptureStore(filePrefix).getDays())
+            days = sorted(day for day in days if args['from'] <= day <= end)
+            replayed, rows, dayFailures = replay_store(args['store'], filePrefix, name, not args['detail'], days, pool, args['dry_run'])
+            logger.info(("Would rewrite " if args['dry_run'] else "Rewrote ") + str(replayed) + " of " + str(len(days)) + " day(s) of " + str(store) + ", " + str(rows) + " row(s) changed" +
+                        (", " + str(dayFailures) + " day(s) failed" if dayFailures else ""))
+            failed += dayFailures
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if failed:
+        sys.exit(1)
+
+def report_main (argv):
+    parser = argparse.ArgumentParser(prog='3m50.py report', description="Reports the daily runtime and temperature range of one or more thermostats over a week or a month, to the console, a file or an email.")
+    parser.add_argument('-f', '--fileprefix', help='Prefix of the data files to report on. Can be given several times', action='append', required=True)
+    parser.add_argument('-p', '--period', help="'week' reports the 7 days up to --to, 'month' the month of --to up to --to (Default: week)", choices=['week', 'month'], default='week')
+    parser.add_argument('-z', '--to', help='Last day to report on, YYYY-MM-DD (Default: yesterday)', type=parse_date, default=None)
+    parser.add_argument('-b', '--store', help="Store to report on. In an SQLite database the samples are under the file name of the prefix (Default: text)", metavar='{' + ','.join(storeTypes) + '}', type=parse_store, default='text')
+    parser.add_argument('-o', '--output', help="File to write the report to")
+    parser.add_argument('-e', '--email', help='Email address to send the report to')
+    parser.add_argument('-m', '--nohtml', help="Write the report as text instead of an HTML table", action="store_true", default=False)
+    parser.add_argument('-S', '--smtp', help="Mail server to send the email through, HOST[:PORT] (Default: localhost:25)", metavar='HOST[:PORT]', type=parse_smtp, default=('localhost', 25))
+    parser.add_argument('-F', '--mail-from', help="Sender address of the email (Default: rouble@gmail.com)", default='rouble@gmail.com')
+    parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
+    args = vars(parser.parse_args(argv))
+
+    setupLogger(None, args['verbose'])
+
+    end = args['to'] if args['to'] is not None else get_yesterday(datetime.now())
+    days = get_report_days(args['period'], end)
+    title = ("Weekly" if args['period'] == 'week' else "Monthly") + " report, " + convert_date_to_str_YYYYMMDD_with_slash(days[0]) + " to " + convert_date_to_str_YYYYMMDD_with_slash(days[-1])
+    devices = []
+    for filePrefix in args['fileprefix']:
+        filePrefix = get_absolute_path(filePrefix)
+        name = os.path.basename(filePrefix)
+        devices.append((name, create_store(args['store'], filePrefix, name, hourly=True)))
+
+    # The report goes to the output file, or to a temporary one for the
+    # email body, or else to the console
+    out = None
+    if args['output'] is not None:
+        out = open(get_absolute_path(args['output']), 'w+')
+    elif args['email'] is not None:
+        out = tempfile.TemporaryFile()
+    if out is not None:
+        write = lambda line: out.write(line + "\n")
+    else:
+        write = logger.info
+    html = not args['nohtml'] and out is not None
+    writer = HtmlReportWriter(write) if html else TextReportWriter(write)
+    try:
+        totals = write_report(writer, devices, days, title)
+        if args['email'] is not None:
+            out.flush()
+            out.seek(0)
+            message = MIMEText(out.read(), 'html' if html else 'plain')
+            message['To'] = args['email']
+            message['Subject'] = "3m50: " + title + ": " + str(totals)
+            mailer = Mailer(args['smtp'][0], args['smtp'][1], args['mail_from'])
+            if mailer.send([(args['email'], message)]) == 0:
+                sys.exit(1)
+    finally:
+        if out is not None:
+            out.close()
+
+def follow_main (argv):
+    parser = argparse.ArgumentParser(prog='3m50.py follow', description='Prints samples as they are appended to the data files of a thermostat, like tail -f, moving on to the next day file after midnight.')
+    parser.add_argument('-f', '--fileprefix', help='Prefix of the data files to follow', required=True)
+    parser.add_argument('-b', '--store', help="Format of the data files (Default: text)", choices=['text', 'binary'], default='text')
+    parser.add_argument('-a', '--all', help="Start with the samples already in the current day file", action="store_true", default=False)
+    parser.add_argument('-i', '--interval', help="Seconds between checks for new samples (Default: 5)", type=float, default=5)
+    parser.add_argument('-j', '--json', help="Print samples as JSON, one per line", action="store_true", default=False)
+    parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
+    args = vars(parser.parse_args(argv))
+
+    setupLogger(None, args['verbose'])
+
+    if not args['json']:
+        logger.info(first_commented_line)
+    try:
+        for day, sample in follow(get_absolute_path(args['fileprefix']), args['store'], args['all'], args['interval']):
+            if args['json']:
+                logger.info(json.dumps(get_sample_row(day, sample), sort_keys=True))
+            else:
+                logger.info(format_csv_line(sample))
+    except KeyboardInterrupt:
+        pass
+
+def parse_date(value):
+    # Argparse type for YYYY-MM-DD dates
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '" + value + "', expected YYYY-MM-DD")
+
+def analyze_main (argv):
+    parser = argparse.ArgumentParser(prog='3m50.py analyze', description='Summarizes the data files of one or more thermostats over a range of days: runtime, runtime per degree of indoor/outdoor temperature difference, runtime against heating/cooling degree hours, and heat/cool duty cycle by hour of day.')
+    parser.add_argument('-f', '--fileprefix', help='Prefix of the data files to analyze. Can be given several times', action='append', required=True)
+    parser.add_argument('-a', '--from', help='First day to analyze, YYYY-MM-DD (Default: the first day there is data for)', type=parse_date, default=date.min)
+    parser.add_argument('-z', '--to', help='Last day to analyze, YYYY-MM-DD (Default: the last day there is data for)', type=parse_date, default=date.max)
+    parser.add_argument('-g', '--by', help="How to group the results (Default: month)", choices=['month', 'season', 'device'], default='month')
+    parser.add_argument('-b', '--store', help="Format of the data files (Default: text)", choices=['text', 'binary'], default='text')
+    parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
+    args = vars(parser.parse_args(argv))
+
+    if numpy is None:
+        parser.error("analyze needs numpy, which is not installed")
+
+    setupLogger(None, args['verbose'])
+
+    filePrefixes = [get_absolute_path(filePrefix) for filePrefix in args['fileprefix']]
+    columns = load_columns(filePrefixes, args['store'], args['from'], args['to'])
+    analyze(columns, args['by'], [os.path.basename(filePrefix) for filePrefix in filePrefixes])
+
+# Subcommands, e.g. '3m50.py convert ...'. Without one we poll thermostats.
+commands = {
+    'analyze': analyze_main,
+    'compact': compact_main,
+    'convert': convert_main,
+    'follow': follow_main,
+    'replay': replay_main,
+    'report': report_main,
+}
+
 # int main(int argc, char *argv[]);
 def crux ():
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+
     now = datetime.now() #Get current runtime. This is used consistently throughout script.
 
     #Setup argparse
     parser = argparse.ArgumentParser(description='Dumps the date, time, outdoor temperature, desired indoor temperature, actual indoor temperature, heat runtime, cool runtime to the specified file in csv format.')
     summaryForSubject = ["yesterdays", "todays", "total"]
-    parser.add_argument('-t', '--tstat', help='Thermostat hostname or IP Address', required=True)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('-t', '--tstat', help='Thermostat hostname or IP Address')
+    target.add_argument('-c', '--fleet', help='JSON file listing several thermostats to poll concurrently')
     parser.add_argument('-k', '--key', help='Weather Underground Key')
     parser.add_argument('-u', '--url', help='Wunderground URL Suffix for your city (Default: \'/q/NC/Cary.json\')', default='/q/NC/Cary.json')
+    parser.add_argument('-W', '--weather', help="Where to get the outdoor temperature: 'wunderground' (needs --key), or a fixed temperature in F with stub:TEMPERATURE (Default: wunderground)", metavar='{' + ','.join(weatherBackends) + '}', type=parse_weather, default='wunderground')
+    parser.add_argument('-T', '--weather-ttl', help="Seconds an outdoor temperature is reused for the same location (Default: 600)", type=int, default=600)
+    parser.add_argument('-C', '--weather-cache', help="File to share cached outdoor temperatures between runs and processes")
     parser.add_argument('-f', '--fileprefix', help='File to store CSV results in.  Note, script will attach a suffix of _YYYY_MM_DD.txt.')
     parser.add_argument('-e', '--email', help='Email address to send report')
     parser.add_argument('-n', '--nickname', help='Name for your thermostat for your emailed report')
@@ -558,45 +3712,90 @@ def crux ():
     parser.add_argument('-s', '--subject', help="What usage summary to show in email subject", choices=summaryForSubject, default='yesterdays')
     parser.add_argument('-l', '--logfile', help="Logging file", action="store", default=None)
     parser.add_argument('-v', '--verbose', help="Enable verbose debugs", action="store_true", default=False)
-    parser.add_argument('-y', '--sync', help="Syncronize thermostat's time with client machine", action="store_true", default=False)
+    parser.add_argument('-y', '--sync', help="Syncronize thermostat's time with client machine, after a sample and only if it is off by more than --sync-threshold", action="store_true", default=False)
+    parser.add_argument('-X', '--sync-threshold', help="Seconds a thermostat's clock has to be off by for --sync to set it (Default: 30)", type=int, default=30)
+    parser.add_argument('-w', '--workers', help="Number of thermostats to poll at once in fleet mode (Default: 8)", type=int, default=8)
+    parser.add_argument('-o', '--timeout', help="Seconds to wait for each thermostat before giving up on it (Default: 60)", type=int, default=60)
+    parser.add_argument('-B', '--budget', help="Seconds collecting a sample may take. Sources that have not answered by then are recorded as '--' (Default: 30)", type=int, default=30)
+    parser.add_argument('-Y', '--fsync', help="When to force samples to disk: 'never' (leave it to the OS), after every 'append', or once per 'run' for all files written to (Default: never)", choices=['never', 'append', 'run'], default='never')
+    parser.add_argument('-J', '--metrics-json', help="File to append timings and counters of every run to, one JSON line per run")
+    parser.add_argument('-P', '--metrics-textfile', help="File to write timings and counters of the last run to, for Prometheus' node exporter textfile collector (e.g. /var/lib/node_exporter/3m50.prom)")
+    parser.add_argument('-d', '--daemon', help="Keep running and sample on a schedule instead of once", action="store_true", default=False)
+    parser.add_argument('-b', '--store', help="How to store samples: 'text' files, fixed size 'binary' record files, or an SQLite database with sqlite:PATH (Default: text)", metavar='{' + ','.join(storeTypes) + '}', type=parse_store, default='text')
+    parser.add_argument('-i', '--interval', help="Minutes between samples in daemon mode, or between samples of a thermostat that heats or cools with --adaptive. Samples off the top of the hour go to _detail files (Default: 60, 5 with --adaptive)", type=int, choices=[1, 2, 3, 4, 5, 6, 10, 12, 15, 20, 30, 60], default=None)
+    parser.add_argument('-a', '--adaptive', help="Sample each thermostat as often as its state calls for: every --interval minutes while it heats or cools, every --idle-interval minutes while idle and hourly when off. Implies --daemon", action="store_true", default=False)
+    parser.add_argument('-I', '--idle-interval', help="Minutes between samples of an idle thermostat with --adaptive. It may not be less than --interval (Default: 30)", type=int, default=30)
+    parser.add_argument('-R', '--requests-per-hour', help="Requests to each thermostat per hour that --adaptive stays within, apart from the hourly sample (Default: 30)", type=int, default=30)
+    parser.add_argument('-L', '--leases', help="Directory of leases to share the thermostats with other processes using it, on this or other hosts: each polls its share and takes over those of processes that stop. Implies --daemon")
+    parser.add_argument('-S', '--smtp', help="Mail server to send emails through, HOST[:PORT] (Default: localhost:25)", metavar='HOST[:PORT]', type=parse_smtp, default=('localhost', 25))
+    parser.add_argument('-p', '--serve', help="Also serve the latest samples of every thermostat as JSON on [HOST:]PORT, from memory. Implies --daemon (Default HOST: 127.0.0.1)", metavar='[HOST:]PORT', type=parse_listen)
+    parser.add_argument('-N', '--buffer', help="Latest samples kept in memory per thermostat for --serve (Default: 288)", type=int, default=288)
+    parser.add_argument('-F', '--mail-from', help="Sender address of emails (Default: rouble@gmail.com)", default='rouble@gmail.com')
+    parser.add_argument('-K', '--capture', help="Also keep the /tstat and /tstat/datalog responses every sample is made from, in <fileprefix>_YYYY_MM_DD.capture files, so that '3m50.py replay' can make the samples again later", action="store_true", default=False)
 
     # Parse arguments
     args = vars(parser.parse_args())
+    if args['interval'] is None:
+        args['interval'] = 5 if args['adaptive'] else 60
+    if args['adaptive'] and args['idle_interval'] < args['interval']:
+        parser.error("--idle-interval (" + str(args['idle_interval']) + ") may not be less than --interval (" + str(args['interval']) + ") with --adaptive")
 
     # Set variables 
     logfile = get_absolute_path(args['logfile'])
-    nickname = args['nickname']
-    tstat = args['tstat']
-    email = args['email']
     verbose = args['verbose']
     key = args['key']
-    url = args['url']
-    fileprefix = get_absolute_path(args['fileprefix'])
-    hour = args['hour']
-    html = not args['nohtml']
-    subject = args['subject']
-    sync = args['sync']
+    timeout = args['timeout']
 
     setupLogger (logfile, verbose)
 
-    # Initialize the thermostat
-    thermostat = Thermostat(tstat)
+    if args['fleet'] is not None:
+        key, devices = load_fleet(get_absolute_path(args['fleet']), args)
+    else:
+        devices = [get_device_from_args(args)]
 
-    # Test if the thermostat is up
-    if thermostat.isUp() == False:
-        # Send failure email
-        report_failure(nickname, tstat, email)
-        sys.exit(1)
+    weather = create_weather_provider(args['weather'], key, timeout, args['weather_ttl'], get_absolute_path(args['weather_cache']))
+    mailer = Mailer(args['smtp'][0], args['smtp'][1], args['mail_from'], timeout)
+    metrics = Metrics(get_absolute_path(args['metrics_json']), get_absolute_path(args['metrics_textfile']))
+    samples = SampleBuffer(max(1, args['buffer'])) if args['serve'] is not None else None
+    session = Session(weather, timeout, args['store'], mailer, args['budget'], metrics, FileSyncer(args['fsync']), samples, args['capture'])
+    workers = max(1, args['workers'])
 
-    # Collect current data from 3m50 and dump it to the file
-    dump_data(thermostat, fileprefix, key, url, now, email, nickname, html)
+    scheduler = None
+    if args['adaptive']:
+        scheduler = AdaptiveScheduler(args['interval'], args['idle_interval'], max(1, args['requests_per_hour']))
 
-    # Print report to STDOUT and also email if necessary
-    if fileprefix is not None:
-        report(nickname, tstat, fileprefix, email, now, hour, html, subject)
-    #else: dump_data takes care of sending an email if there are no stateful files.
+    leases = None
+    if args['leases'] is not None:
+        leases = LeaseKeeper(get_absolute_path(args['leases']), devices)
 
-    if sync:
-        thermostat.syncTime()
+    if args['serve'] is not None:
+        seed_samples(session, devices, now)
+        try:
+            serve_samples(samples, args['serve'])
+        except socket.error as e:
+            logger.error("Could not listen on " + args['serve'][0] + ":" + str(args['serve'][1]))
+            logger.exception(e)
+            sys.exit(1)
+    if args['daemon'] or args['adaptive'] or args['serve'] is not None or leases is not None:
+        if leases is not None:
+            leases.start()
+        try:
+            run_daemon(session, devices, workers, args['interval'], scheduler, leases)
+        finally:
+            if leases is not None:
+                leases.stop()
+    elif args['fleet'] is not None:
+        results = run_fleet(session, devices, now, workers)
+        sync_clocks(session, [device for device in devices if results.get(device['tstat'])], now, workers)
+        session.finishRun()
+        if not all(results.get(device['tstat'], False) for device in devices):
+            sys.exit(1)
+    else:
+        up = poll_thermostat(session, devices[0], now)
+        if up:
+            sync_clocks(session, devices, now, 1)
+        session.finishRun()
+        if up == False:
+            sys.exit(1)
 
 if __name__ == "__main__":  crux()
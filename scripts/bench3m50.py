@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+# Benchmarks 3m50.py against fake thermostats (see fake3m50.py), so that
+# changes to polling can be measured the same way on any machine, without
+# a thermostat or a network. For each scenario it reports the wall time of a
+# sample and how many requests it took:
+#
+#   single    one thermostat, a fresh session per sample like a cron job
+#   fleet     --count thermostats polled together, as with --fleet
+#   midnight  the midnight sample of one thermostat whose clock is --skew
+#             seconds off, including the stall waiting for its rollover
+#
+# 3m50.py runs in this process, with its clock moved for the midnight
+# scenario. The fake thermostats run in a process of their own.
+
+from datetime import datetime, timedelta
+import argparse
+import imp
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+scenarios = ['single', 'fleet', 'midnight']
+
+class MovedTime(object):
+    # Stands in for the time module of 3m50.py, with the clock moved by
+    # offset seconds
+    def __init__(self, offset):
+        self.offset = offset
+    def time(self):
+        return time.time() + self.offset
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class FakeThermostats(object):
+    # Runs fake3m50.py with count thermostats from port on
+    def __init__(self, port, count, options):
+        self.port = port
+        self.count = count
+        self.options = options
+        self.process = None
+    def start(self):
+        command = [sys.executable, os.path.join(scriptDir, 'fake3m50.py'), '--port', str(self.port), '--count', str(self.count)] + self.options
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        # It prints a line once it is listening
+        if not self.process.stdout.readline():
+            raise IOError("fake3m50.py did not start: " + " ".join(command))
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+    def getHostNames(self):
+        return ['127.0.0.1:' + str(self.port + i) for i in xrange(self.count)]
+    def getStats(self):
+        # Requests and connections summed over all thermostats
+        requests = 0
+        connections = 0
+        for hostName in self.getHostNames():
+            stats = json.loads(urllib2.urlopen('http://' + hostName + '/stats', timeout=5).read())
+            requests += sum(stats['requests'].values())
+            connections += stats['connections']
+        return requests, connections
+
+def create_device(m, hostName, filePrefix):
+    device = dict((key, None) for key in m.deviceKeys)
+    device.update({'tstat': hostName, 'nickname': hostName.replace(':', '_'), 'fileprefix': filePrefix,
+                   'nohtml': True, 'subject': 'yesterdays', 'sync': False, 'url': '/q/NC/Cary.json'})
+    return device
+
+def create_session(m, args, dataDir):
+    weather = m.create_weather_provider('stub:50', None, args['timeout'], 600, None)
+    storeType = args['store']
+    if storeType == 'sqlite':
+        storeType = 'sqlite:' + os.path.join(dataDir, 'bench.db')
+    return m.Session(weather, args['timeout'], storeType, None, args['budget'])
+
+def get_sample_time(i):
+    # When sample i of a scenario is taken. Each sample gets an hour of its
+    # own, away from midnight, so that none is skipped as a duplicate of
+    # the one before and every one of them is appended.
+    day = datetime.now().date() + timedelta(i // 23)
+    return datetime.combine(day, datetime.min.time()) + timedelta(hours=1 + i % 23)
+
+def check_rows(m, session, device, samples):
+    # Every sample should have been appended as a row of its own
+    store = session.getStore(device)
+    days = set(m.get_current_day(get_sample_time(i)) for i in xrange(samples))
+    rows = sum(len(store.getSamples(day)) for day in days)
+    if rows != samples:
+        raise RuntimeError(device['tstat'] + " has " + str(rows) + " rows instead of " + str(samples))
+
+def measure(fakes, poll):
+    # Returns the wall time of poll() and the requests and new connections
+    # it made
+    requests, connections = fakes.getStats()
+    startedAt = time.time()
+    poll()
+    wallTime = time.time() - startedAt
+    newRequests, newConnections = fakes.getStats()
+    return wallTime, newRequests - requests, newConnections - connections
+
+def get_result(scenario, devices, samples, wallTimes, requests, connections):
+    return {'scenario': scenario, 'devices': devices, 'samples': samples,
+            'wall': sum(wallTimes), 'perSample': sum(wallTimes)/len(wallTimes), 'slowest': max(wallTimes),
+            'requests': requests, 'requestsPerSample': requests/float(samples*devices), 'connections': connections}
+
+def bench_single(m, args, dataDir, fakeOptions):
+    fakes = FakeThermostats(args['port'], 1, fakeOptions)
+    fakes.start()
+    try:
+        device = create_device(m, fakes.getHostNames()[0], os.path.join(dataDir, 'single'))
+        wallTimes, requests, connections = [], 0, 0
+        for i in xrange(args['samples']):
+            # A new session every time, like one cron job after the other
+            session = create_session(m, args, dataDir)
+            wallTime, newRequests, newConnections = measure(fakes, lambda: m.poll_thermostat(session, device, get_sample_time(i)))
+            wallTimes.append(wallTime)
+            requests += newRequests
+            connections += newConnections
+        check_rows(m, session, device, args['samples'])
+        return get_result('single', 1, args['samples'], wallTimes, requests, connections)
+    finally:
+        fakes.stop()
+
+def bench_fleet(m, args, dataDir, fakeOptions):
+    fakes = FakeThermostats(args['port'], args['count'], fakeOptions)
+    fakes.start()
+    try:
+        devices = [create_device(m, hostName, os.path.join(dataDir, 'fleet_' + str(i))) for i, hostName in enumerate(fakes.getHostNames())]
+        wallTimes, requests, connections = [], 0, 0
+        # One session for all samples, like the daemon
+        session = create_session(m, args, dataDir)
+        for i in xrange(args['samples']):
+            wallTime, newRequests, newConnections = measure(fakes, lambda: m.run_fleet(session, devices, get_sample_time(i), args['workers']))
+            wallTimes.append(wallTime)
+            requests += newRequests
+            connections += newConnections
+        for device in devices:
+            check_rows(m, session, device, args['samples'])
+        return get_result('fleet', len(devices), args['samples'], wallTimes, requests, connections)
+    finally:
+        fakes.stop()
+
+def bench_midnight(m, args, dataDir, fakeOptions):
+    # Move the clock to just after the coming midnight. The thermostat's
+    # clock is --skew seconds off, so when it is behind ours the midnight
+    # sample has to wait for it to roll over.
+    midnight = datetime.combine(datetime.now().date() + timedelta(1), datetime.min.time())
+    offset = time.mktime((midnight + timedelta(seconds=1)).timetuple()) - time.time()
+    fakes = FakeThermostats(args['port'], 1, fakeOptions + ['--clock-offset', str(offset), '--skew', str(args['skew'])])
+    fakes.start()
+    realTime = m.time
+    m.time = MovedTime(offset)
+    try:
+        device = create_device(m, fakes.getHostNames()[0], os.path.join(dataDir, 'midnight'))
+        session = create_session(m, args, dataDir)
+
+        # The 23:00 sample, whose runtime the midnight sample builds on
+        m.poll_thermostat(session, device, midnight - timedelta(hours=1))
+
+        now = datetime.fromtimestamp(m.time.time())
+        wallTime, requests, connections = measure(fakes, lambda: m.poll_thermostat(session, device, now))
+        result = get_result('midnight', 1, 1, [wallTime], requests, connections)
+        result['stall'] = wallTime
+
+        # The fake thermostat's heat runs a quarter of the day, so the
+        # midnight sample should have a total of 360 minutes. Anything else
+        # means it took the day before's runtime, from before the thermostat
+        # moved today's to yesterday.
+        sample = session.getStore(device).getLastSample(m.get_current_day(now))
+        result['heatTotal'] = sample.heatTotal if sample is not None else None
+        return result
+    finally:
+        m.time = realTime
+        fakes.stop()
+
+benchmarks = {
+    'single': bench_single,
+    'fleet': bench_fleet,
+    'midnight': bench_midnight,
+}
+
+def format_result(result):
+    line = '{:<10}'.format(result['scenario'])
+    line += '{:>8}'.format(result['devices'])
+    line += '{:>8}'.format(result['samples'])
+    line += '{:>10.3f}'.format(result['wall'])
+    line += '{:>12.3f}'.format(result['perSample'])
+    line += '{:>10.3f}'.format(result['slowest'])
+    line += '{:>10}'.format(result['requests'])
+    line += '{:>14.2f}'.format(result['requestsPerSample'])
+    line += '{:>13}'.format(result['connections'])
+    if 'stall' in result:
+        line += '{:>10.3f}'.format(result['stall'])
+        line += '{:>12}'.format('--' if result['heatTotal'] is None else result['heatTotal'])
+    return line
+
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmarks 3m50.py against fake thermostats: wall time, requests per sample and the midnight stall, for a single thermostat and for a fleet.')
+    parser.add_argument('scenario', help='Scenarios to run, from ' + ', '.join(scenarios) + ' (Default: all)', nargs='*')
+    parser.add_argument('-n', '--samples', help='Samples to take per scenario (Default: 5)', type=int, default=5)
+    parser.add_argument('-c', '--count', help='Number of thermostats in the fleet (Default: 8)', type=int, default=8)
+    parser.add_argument('-w', '--workers', help='Thermostats to poll at once in the fleet (Default: 8)', type=int, default=8)
+    parser.add_argument('-l', '--latency', help='Milliseconds the thermostats take to answer (Default: 50)', type=float, default=50)
+    parser.add_argument('-j', '--jitter', help='Up to this many more milliseconds of random delay (Default: 20)', type=float, default=20)
+    parser.add_argument('-x', '--failure-rate', help='Fraction of requests that fail (Default: 0)', type=float, default=0)
+    parser.add_argument('-k', '--skew', help="Seconds the thermostat's clock is ahead of ours in the midnight scenario (Default: -10)", type=float, default=-10)
+    parser.add_argument('-t', '--transfer-delay', help="Seconds after midnight before the thermostat moves the day's runtime. It is past the thermostat's rollover, so the midnight sample sees the day before in yesterday's bucket first (Default: 6)", type=float, default=6)
+    parser.add_argument('-s', '--stale-day', help="Runtime of the day before yesterday, which the thermostat keeps until it moves the day's runtime, as a fraction of a full day. More than 1 is more than the day being sampled (Default: 1.5)", type=float, default=1.5)
+    parser.add_argument('-o', '--timeout', help='Seconds to wait for each thermostat (Default: 10)', type=int, default=10)
+    parser.add_argument('-B', '--budget', help='Seconds collecting a sample may take (Default: 5)', type=int, default=5)
+    parser.add_argument('-b', '--store', help='How to store samples (Default: text)', choices=['text', 'binary', 'sqlite'], default='text')
+    parser.add_argument('-p', '--port', help='Port of the first fake thermostat (Default: 18500)', type=int, default=18500)
+    parser.add_argument('-J', '--json', help='Print the results as JSON, one line per scenario', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose', help='Show what 3m50.py logs', action='store_true', default=False)
+    args = vars(parser.parse_args())
+    for scenario in args['scenario']:
+        if scenario not in scenarios:
+            parser.error("unknown scenario '" + scenario + "', choose from " + ", ".join(scenarios))
+
+    m = imp.load_source('threem50', os.path.join(scriptDir, '3m50.py'))
+    # Only warnings and errors, the samples themselves are not of interest
+    m.logger = logging.getLogger('3m50')
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(logging.DEBUG if args['verbose'] else logging.WARNING)
+    m.logger.addHandler(handler)
+    m.logger.setLevel(logging.DEBUG)
+
+    fakeOptions = ['--latency', str(args['latency']), '--jitter', str(args['jitter']), '--failure-rate', str(args['failure_rate']), '--transfer-delay', str(args['transfer_delay']), '--stale-day', str(args['stale_day'])]
+
+    if not args['json']:
+        header = '{:<10}'.format('scenario') + '{:>8}'.format('devices') + '{:>8}'.format('samples') + '{:>10}'.format('wall s') + '{:>12}'.format('per sample') + '{:>10}'.format('slowest') + \
+                 '{:>10}'.format('requests') + '{:>14}'.format('req/sample') + '{:>13}'.format('connections') + '{:>10}'.format('stall s') + '{:>12}'.format('heat total')
+        print header
+
+    for scenario in args['scenario'] or scenarios:
+        dataDir = tempfile.mkdtemp(prefix='3m50_bench_')
+        try:
+            result = benchmarks[scenario](m, args, dataDir, fakeOptions)
+        finally:
+            shutil.rmtree(dataDir)
+        if args['json']:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print format_result(result)
+        sys.stdout.flush()
+
+if __name__ == "__main__":  main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+# A fake 3m50 for testing and benchmarking 3m50.py without a thermostat or
+# a network. It serves /tstat and /tstat/datalog the way the real device
+# does, with configurable latency, jitter and failures, a clock that can be
+# skewed from (and shifted with) the host's, and a midnight rollover that
+# moves today's runtime to yesterday's bucket after a delay.
+#
+# Several thermostats can be served at once, one per port starting at
+# --port. GET /stats returns the requests and connections a thermostat has
+# seen so far; it is not counted itself.
+
+from datetime import datetime
+import argparse
+import BaseHTTPServer
+import json
+import random
+import SocketServer
+import sys
+import threading
+import time
+
+class FakeClock(object):
+    # The host's clock moved by offset seconds, so that e.g. midnight can be
+    # simulated at any time of the day.
+    def __init__(self, offset=0):
+        self.offset = offset
+    def time(self):
+        return time.time() + self.offset
+
+class FakeThermostat(object):
+    # The state of one simulated 3m50. Its clock is the fake host clock plus
+    # skew seconds. The heat runs duty of every minute, and transferDelay
+    # seconds after the device's midnight the day's runtime is moved to
+    # yesterday's bucket. Until then yesterday's bucket holds the day
+    # before, which ran staleDay times as long as a full day at duty.
+    def __init__(self, clock, skew=0, duty=0.25, transferDelay=2, latency=0, jitter=0, failureRate=0, failureMode='error', staleDay=0.5):
+        self.clock = clock
+        self.skew = skew
+        self.duty = duty
+        self.transferDelay = transferDelay
+        self.staleDay = staleDay
+        self.latency = latency
+        self.jitter = jitter
+        self.failureRate = failureRate
+        self.failureMode = failureMode
+        self.requests = {}
+        self.failures = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+    def getDeviceTime(self):
+        return datetime.fromtimestamp(self.clock.time() + self.skew)
+    def setDeviceTime(self, hour, minute):
+        # Like the real device we only get hour and minute, and the seconds
+        # start over from 0.
+        now = self.getDeviceTime()
+        wanted = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        self.skew += (wanted - now).total_seconds()
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+    def countConnection(self):
+        with self.lock:
+            self.connections += 1
+    def delay(self):
+        seconds = self.latency + random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+    def shouldFail(self):
+        if self.failureRate > 0 and random.random() < self.failureRate:
+            with self.lock:
+                self.failures += 1
+            return True
+        return False
+    def getTstat(self):
+        now = self.getDeviceTime()
+        return {"temp": 65.5, "tmode": 1, "fmode": 0, "override": 0, "hold": 0, "t_heat": 64.0,
+                "tstate": 1 if now.minute < self.duty*60 else 0,
+                "time": {"day": now.weekday(), "hour": now.hour, "minute": now.minute}}
+    def getRuntime(self, minutes):
+        minutes = int(minutes*self.duty)
+        return {"hour": minutes/60, "minute": minutes%60}
+    def getDatalog(self):
+        now = self.getDeviceTime()
+        secondsOfDay = now.hour*60*60 + now.minute*60 + now.second
+        if secondsOfDay < self.transferDelay:
+            # Just rolled over, but the day's runtime has not moved yet.
+            # Yesterday's bucket still holds the day before.
+            today, yesterday = 24*60, 24*60*self.staleDay
+        else:
+            today, yesterday = secondsOfDay/60, 24*60
+        return {"today": {"heat_runtime": self.getRuntime(today), "cool_runtime": self.getRuntime(0)},
+                "yesterday": {"heat_runtime": self.getRuntime(yesterday), "cool_runtime": self.getRuntime(0)}}
+    def getStats(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "failures": self.failures, "connections": self.connections,
+                    "skew": self.skew}
+
+class FakeThermostatHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.counted = False
+    def count(self, path):
+        # Connections only count once they ask the thermostat something,
+        # so that the ones asking for /stats do not
+        if not self.counted:
+            self.server.thermostat.countConnection()
+            self.counted = True
+        self.server.thermostat.count(path)
+    def do_GET(self):
+        thermostat = self.server.thermostat
+        if self.path == '/stats':
+            self.sendJson(thermostat.getStats())
+            return
+        if self.path not in ('/tstat', '/tstat/datalog'):
+            self.send_error(404)
+            return
+        self.count(self.path)
+        if self.fail():
+            return
+        if self.path == '/tstat':
+            self.sendJson(thermostat.getTstat())
+        else:
+            self.sendJson(thermostat.getDatalog())
+    def do_POST(self):
+        thermostat = self.server.thermostat
+        if self.path != '/tstat':
+            self.send_error(404)
+            return
+        self.count('POST ' + self.path)
+        body = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+        if self.fail():
+            return
+        if 'time' in body:
+            thermostat.setDeviceTime(body['time']['hour'], body['time']['minute'])
+        self.sendJson({"success": 0})
+    def fail(self):
+        thermostat = self.server.thermostat
+        thermostat.delay()
+        if not thermostat.shouldFail():
+            return False
+        if thermostat.failureMode == 'hang':
+            # Never answer, the client has to time out
+            time.sleep(24*60*60)
+        elif thermostat.failureMode == 'drop':
+            self.close_connection = 1
+        else:
+            self.send_error(503)
+        return True
+    def sendJson(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write(str(self.server.server_address[1]) + ": " + (format % args) + "\n")
+
+class FakeThermostatServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, thermostat, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeThermostatHandler)
+        self.thermostat = thermostat
+        self.verbose = verbose
+
+def serve(port, count, createThermostat, verbose=False):
+    # Starts count thermostats on consecutive ports, each served from a
+    # daemon thread
+    servers = []
+    for i in xrange(count):
+        server = FakeThermostatServer(('127.0.0.1', port + i), createThermostat(), verbose)
+        thread = threading.Thread(target=server.serve_forever, name=str(port + i))
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+    return servers
+
+def main ():
+    parser = argparse.ArgumentParser(description='Serves one or more fake 3m50 thermostats on 127.0.0.1, for testing and benchmarking 3m50.py.')
+    parser.add_argument('-p', '--port', help='Port of the first thermostat (Default: 18500)', type=int, default=18500)
+    parser.add_argument('-n', '--count', help='Number of thermostats, on consecutive ports (Default: 1)', type=int, default=1)
+    parser.add_argument('-l', '--latency', help='Milliseconds every response is delayed by (Default: 0)', type=float, default=0)
+    parser.add_argument('-j', '--jitter', help='Up to this many more milliseconds of random delay (Default: 0)', type=float, default=0)
+    parser.add_argument('-x', '--failure-rate', help='Fraction of requests that fail (Default: 0)', type=float, default=0)
+    parser.add_argument('-m', '--failure-mode', help="How requests fail: with an HTTP 503 'error', by dropping the connection, or by never answering (Default: error)", choices=['error', 'drop', 'hang'], default='error')
+    parser.add_argument('-k', '--skew', help="Seconds the thermostats' clocks are ahead of the host's (Default: 0)", type=float, default=0)
+    parser.add_argument('-o', '--clock-offset', help="Seconds the host's clock is moved by, e.g. to be just before midnight (Default: 0)", type=float, default=0)
+    parser.add_argument('-d', '--duty', help='Fraction of the time the heat runs (Default: 0.25)', type=float, default=0.25)
+    parser.add_argument('-t', '--transfer-delay', help="Seconds after midnight before the day's runtime moves to yesterday (Default: 2)", type=float, default=2)
+    parser.add_argument('-s', '--stale-day', help="Runtime of the day before yesterday, which yesterday's bucket holds until the transfer, as a fraction of a full day at --duty (Default: 0.5)", type=float, default=0.5)
+    parser.add_argument('-v', '--verbose', help='Log every request', action='store_true', default=False)
+    args = vars(parser.parse_args())
+
+    clock = FakeClock(args['clock_offset'])
+    def createThermostat():
+        return FakeThermostat(clock, args['skew'], args['duty'], args['transfer_delay'], args['latency']/1000.0, args['jitter']/1000.0, args['failure_rate'], args['failure_mode'], args['stale_day'])
+    serve(args['port'], args['count'], createThermostat, args['verbose'])
+
+    # Tell whoever started us that we are listening
+    sys.stdout.write("Serving " + str(args['count']) + " fake thermostat(s) from port " + str(args['port']) + "\n")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":  main()